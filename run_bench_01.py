@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for Task 1
+"""
+
+from tasks import bench_file_sort_copy
+
+
+if __name__ == "__main__":
+    bench_file_sort_copy()
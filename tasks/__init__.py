@@ -4,6 +4,7 @@ __title__ = 'Home Work Tasks'
 __author__ = 'Roman'
 
 from .task_01 import cli as test_file_sort_copy
+from .task_01_bench import cli as bench_file_sort_copy
 from .task_02 import cli as test_map_reduce
 
-__all__ = ['test_file_sort_copy', 'test_map_reduce']
+__all__ = ['test_file_sort_copy', 'bench_file_sort_copy', 'test_map_reduce']
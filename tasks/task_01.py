@@ -6,13 +6,901 @@ HomeWork Task 1
 
 import asyncio
 import argparse
+import datetime
+import errno
+import fnmatch
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue as queue_module
+import re
+import sqlite3
+import sys
 import time
+import uuid
+import zlib
 
 from aiopath import AsyncPath
-from aioshutil import copyfile
-from collections import defaultdict
-from typing import Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Container, Hashable, Iterator, NamedTuple, Optional, TextIO, Union
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows - the reflink copy is not supported there
+    fcntl = None
+
+
+# Default number of concurrent copy workers
+DEFAULT_WORKERS: int = 16
+# Default maximum number of discovered files waiting in the copy queue
+DEFAULT_QUEUE_SIZE: int = 1000
+# Default number of folders scanned concurrently
+DEFAULT_WALKERS: int = 8
+# Number of files sent to a worker process at once
+SHARD_BATCH_SIZE: int = 500
+# Maximum number of file batches waiting for a worker process
+SHARD_QUEUE_SIZE: int = 16
+# File name of the copy manifest in the destination folder (incremental mode)
+MANIFEST_NAME: str = ".folder_copy_manifest.sqlite"
+# The manifest changes are committed after this number of changes or seconds, whatever comes first
+MANIFEST_COMMIT_CHANGES: int = 1000
+MANIFEST_COMMIT_SECONDS: float = 1.0
+# Files up to this size are copied in batches, one executor job per batch
+DEFAULT_SMALL_FILE_SIZE: int = 64 * 1024
+# Maximum number of the small files in a batch
+SMALL_FILES_BATCH: int = 64
+# Files from this size are copied in chunks, by several executor jobs in parallel
+DEFAULT_LARGE_FILE_SIZE: int = 256 * 1024 * 1024
+# Size of a chunk of a large file
+DEFAULT_CHUNK_SIZE: int = 64 * 1024 * 1024
+# Number of the leading bytes hashed to tell the same-size files apart (deduplication mode)
+PARTIAL_HASH_SIZE: int = 64 * 1024
+# Default number of directory entries processed by one executor call of the folder walk
+DEFAULT_SCAN_BATCH_SIZE: int = 1000
+
+# Buffer size of the buffered (user space) copy
+COPY_BUFFER_SIZE: int = 1024 * 1024
+# ioctl request of the Linux reflink (clone) of a whole file
+FICLONE: int = 0x40049409
+# Errors meaning that the copy method is not supported for the given pair of files
+COPY_UNSUPPORTED_ERRORS: frozenset[int] = frozenset(
+    code for code in (
+        errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP,
+        getattr(errno, "ENOTSUP", errno.EOPNOTSUPP), errno.EBADF, errno.ETXTBSY,
+    )
+)
+
+# Default interval of the progress reports, seconds
+DEFAULT_PROGRESS_INTERVAL: float = 10.0
+
+# Multipliers of the age suffixes accepted on the command line, seconds
+TIME_SUFFIXES: dict[str, int] = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+# Logging levels accepted on the command line
+LOG_LEVELS: list[str] = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+# Default listening address of the metrics endpoint
+DEFAULT_METRICS_HOST: str = "127.0.0.1"
+
+# Interval of the counter updates of the worker processes while the metrics are exposed, seconds
+METRICS_INTERVAL: float = 1.0
+
+# Default number of threads of the dedicated I/O backend
+DEFAULT_IO_THREADS: int = 32
+
+# Multipliers of the size suffixes accepted on the command line
+SIZE_SUFFIXES: dict[str, int] = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+
+def parse_size(value: str) -> int:
+    """
+    Parse a size in bytes with an optional binary suffix (K, M, G, T), e.g. "512M".
+
+    :param value: Size string
+    :return: Size in bytes
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*([kmgt]?)i?b?\s*", value, re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError(f'Invalid size: "{value}"')
+    return int(match.group(1)) * SIZE_SUFFIXES[match.group(2).lower()]
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """
+    Parse a part specification "K/N" (K-th of N parts, starting from 1).
+
+    :param value: Part specification
+    :return: Part index (starting from 0) and the number of the parts
+    """
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", value)
+    if match is None or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError(f'Invalid part: "{value}"')
+    return int(match.group(1)) - 1, int(match.group(2))
+
+
+def parse_time(value: str) -> float:
+    """
+    Parse a point in time: an ISO date or date and time, e.g. "2024-01-31" or "2024-01-31T12:00",
+    or an age with a suffix (s, m, h, d, w), e.g. "7d" for 7 days ago.
+
+    :param value: Time string
+    :return: Time in seconds since the epoch
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smhdw])\s*", value, re.IGNORECASE)
+    if match is not None:
+        return time.time() - float(match.group(1)) * TIME_SUFFIXES[match.group(2).lower()]
+    try:
+        return datetime.datetime.fromisoformat(value.strip()).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid time: "{value}"')
+
+
+class ByteBudget:
+    """
+    Limits the total size of the files which are being copied at the same time.
+
+    A file larger than the whole budget is admitted alone, so it can never block the copying forever.
+    """
+
+    def __init__(self, limit: Optional[int] = None) -> None:
+        """
+        :param limit: Maximum number of bytes in flight (None or 0 - unlimited)
+        """
+        self.limit: Optional[int] = limit or None
+        self.in_flight: int = 0
+        self._condition: asyncio.Condition = asyncio.Condition()
+
+    async def acquire(self, size: int) -> int:
+        """
+        Wait until the specified number of bytes fits into the budget and reserve it.
+
+        :param size: Number of bytes
+        :return: Number of bytes actually reserved (must be passed to release)
+        """
+        if self.limit is None:
+            return 0
+        amount: int = min(size, self.limit)
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight == 0 or self.in_flight + amount <= self.limit)
+            self.in_flight += amount
+        return amount
+
+    async def release(self, amount: int) -> None:
+        """
+        Return the reserved bytes to the budget.
+
+        :param amount: Number of bytes returned by acquire
+        """
+        if self.limit is None:
+            return
+        async with self._condition:
+            self.in_flight -= amount
+            self._condition.notify_all()
+
+    @asynccontextmanager
+    async def reserve(self, size: int) -> AsyncIterator[None]:
+        """
+        Reserve the specified number of bytes for the duration of the context.
+
+        :param size: Number of bytes
+        """
+        amount: int = await self.acquire(size)
+        try:
+            yield
+        finally:
+            await self.release(amount)
+
+
+class CopyStats:
+    """
+    Counters and timings of a copy run.
+
+    The phase timings are cumulative: the durations of the concurrent operations are summed,
+    so a phase may take longer than the whole run.
+    """
+    PHASES: tuple[str, ...] = ("walk", "naming", "mkdir", "copy")
+    COUNTERS: tuple[str, ...] = (
+        "folders", "files_found", "bytes_found", "files_copied", "bytes_copied",
+        "files_skipped", "bytes_skipped", "files_failed", "collisions", "claim_retries", "filtered", "links",
+        "files_linked",
+    )
+    # Upper bounds of the per-file copy latency histogram, seconds
+    LATENCY_BUCKETS: tuple[float, ...] = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, float("inf"))
+
+    def __init__(self) -> None:
+        self.started: float = time.perf_counter()
+        self.folders: int = 0
+        self.files_found: int = 0
+        self.bytes_found: int = 0
+        self.files_copied: int = 0
+        self.bytes_copied: int = 0
+        # Files which are not copied on purpose (up to date, duplicates)
+        self.files_skipped: int = 0
+        self.bytes_skipped: int = 0
+        self.files_failed: int = 0
+        # Destination names which got a copy index because the base name was taken
+        self.collisions: int = 0
+        # Destination names taken by another process between the choice and the claim
+        self.claim_retries: int = 0
+        # Files and folders left out by the walk filters
+        self.filtered: int = 0
+        # Symbolic links skipped by the walk (not followed)
+        self.links: int = 0
+        # Hard links of the already copied source inodes, linked to the copy
+        self.files_linked: int = 0
+        # Per-file copy latency histogram: counts per bucket (not cumulative), sum and count
+        self.latency_buckets: list[int] = [0] * len(self.LATENCY_BUCKETS)
+        self.latency_sum: float = 0.0
+        self.latency_count: int = 0
+        self.walk_done: bool = False
+        # Files being copied right now
+        self.in_flight: int = 0
+        # Queue of the files waiting for the copy workers (for the progress reports)
+        self.queue: Optional[asyncio.Queue] = None
+        self.phases: dict[str, float] = dict.fromkeys(self.PHASES, 0.0)
+        # Latest counters of the running worker processes, by process name (for the metrics)
+        self.parts: dict[str, dict] = {}
+
+    @contextmanager
+    def timed(self, phase: str) -> Iterator[None]:
+        """
+        Add the duration of the context to the phase timing.
+
+        :param phase: Phase name, one of PHASES
+        """
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[phase] += time.perf_counter() - start
+
+    def found(self, size: int) -> None:
+        self.files_found += 1
+        self.bytes_found += size
+
+    def copied(self, size: int) -> None:
+        self.files_copied += 1
+        self.bytes_copied += size
+
+    def skipped(self, size: int) -> None:
+        self.files_skipped += 1
+        self.bytes_skipped += size
+
+    def observe_latency(self, seconds: float, count: int = 1) -> None:
+        """
+        Add the copy latency of files to the histogram.
+
+        :param seconds: Latency of a file, seconds
+        :param count: Number of files with this latency
+        """
+        for index, bound in enumerate(self.LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.latency_buckets[index] += count
+                break
+        self.latency_sum += seconds * count
+        self.latency_count += count
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> dict:
+        """
+        :return: Counters and timings as a JSON-serializable dictionary
+        """
+        result: dict = {counter: getattr(self, counter) for counter in self.COUNTERS}
+        result["elapsed_seconds"] = self.elapsed()
+        result["phase_seconds"] = dict(self.phases)
+        result["latency"] = {
+            "buckets": list(self.latency_buckets),
+            "sum": self.latency_sum,
+            "count": self.latency_count,
+        }
+        return result
+
+    def merge(self, other: dict) -> None:
+        """
+        Add the counters and timings of another run part (e.g. of a worker process).
+
+        :param other: Counters and timings returned by as_dict
+        """
+        for counter in self.COUNTERS:
+            setattr(self, counter, getattr(self, counter) + other.get(counter, 0))
+        for phase, seconds in other.get("phase_seconds", {}).items():
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        if (latency := other.get("latency")) is not None:
+            self.latency_buckets = [mine + theirs for mine, theirs in zip(self.latency_buckets, latency["buckets"])]
+            self.latency_sum += latency["sum"]
+            self.latency_count += latency["count"]
+
+    def progress(self) -> str:
+        """
+        :return: Progress report: rates, queue depth, in-flight copies and the estimated time left
+        """
+        elapsed: float = max(self.elapsed(), 1e-9)
+        bytes_rate: float = self.bytes_copied / elapsed
+        processed: int = self.files_copied + self.files_skipped + self.files_failed
+        eta: str = "unknown"
+        if self.walk_done and bytes_rate > 0:
+            remaining: int = max(self.bytes_found - self.bytes_copied - self.bytes_skipped, 0)
+            minutes, seconds = divmod(int(remaining / bytes_rate), 60)
+            eta = f"{minutes // 60}:{minutes % 60:02d}:{seconds:02d}"
+        return (
+            f"Progress: {processed}/{self.files_found}{'' if self.walk_done else '+'} files "
+            f"({processed / elapsed:.1f} files/s), {self.bytes_copied / 1024 ** 2:.1f} MB copied "
+            f"({bytes_rate / 1024 ** 2:.1f} MB/s), queue {self.queue.qsize() if self.queue is not None else 0}, "
+            f"in flight {self.in_flight}, failed {self.files_failed}, ETA {eta}"
+        )
+
+    def summary(self) -> str:
+        """
+        :return: End of run report: totals and the time spent per phase
+        """
+        phases: str = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in self.phases.items())
+        return (
+            f"Copied {self.files_copied} files ({self.bytes_copied} bytes), skipped {self.files_skipped}, "
+            f"failed {self.files_failed}, scanned {self.folders} folders; cumulative phase time: {phases}"
+        )
+
+
+async def report_progress(stats: CopyStats, interval: float, label: str = "") -> None:
+    """
+    Log the progress of the copy run periodically (until cancelled).
+
+    :param stats: Counters of the copy run
+    :param interval: Report interval, seconds
+    :param label: Label of the reports, e.g. the worker process name
+    """
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(f"{label}: {stats.progress()}" if label else stats.progress())
+
+
+# Exported counters: CopyStats counter, metric name and help
+METRICS_COUNTERS: tuple[tuple[str, str, str], ...] = (
+    ("folders", "folders_scanned", "Source folders scanned"),
+    ("files_found", "files_found", "Source files discovered"),
+    ("bytes_found", "bytes_found", "Size of the source files discovered"),
+    ("files_copied", "files_copied", "Files copied (or linked)"),
+    ("bytes_copied", "bytes_copied", "Size of the files copied (or linked)"),
+    ("files_skipped", "files_skipped", "Files not copied on purpose (up to date, duplicates)"),
+    ("bytes_skipped", "bytes_skipped", "Size of the files not copied on purpose"),
+    ("files_failed", "errors", "Files which failed to copy"),
+    ("collisions", "name_collisions", "Destination names which got a copy index because the base name was taken"),
+    ("claim_retries", "claim_retries", "Destination names taken by another process, claimed again"),
+    ("filtered", "filtered", "Source files and folders left out by the walk filters"),
+    ("links", "symlinks_skipped", "Symbolic links skipped by the walk"),
+    ("files_linked", "hardlinks", "Hard links of the already copied source files, linked to the copy"),
+)
+METRICS_CONTENT_TYPE: str = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render_metrics(stats: CopyStats) -> str:
+    """
+    Render the counters of the copy run, including the running worker processes,
+    in the Prometheus text exposition format.
+
+    :param stats: Counters of the copy run
+    :return: Metrics text
+    """
+    total: CopyStats = CopyStats()
+    total.started = stats.started
+    total.merge(stats.as_dict())
+    in_flight: int = stats.in_flight
+    queued: int = stats.queue.qsize() if stats.queue is not None else 0
+    for part in list(stats.parts.values()):
+        total.merge(part)
+        in_flight += part.get("in_flight", 0)
+        queued += part.get("queued", 0)
+
+    lines: list[str] = []
+
+    def metric(name: str, kind: str, description: str, samples: list[tuple[str, float]]) -> None:
+        lines.append(f"# HELP folder_copy_{name} {description}")
+        lines.append(f"# TYPE folder_copy_{name} {kind}")
+        lines.extend(f"folder_copy_{name}{labels} {value}" for labels, value in samples)
+
+    for counter, name, description in METRICS_COUNTERS:
+        metric(f"{name}_total", "counter", description, [("", getattr(total, counter))])
+    metric("phase_seconds_total", "counter", "Cumulative time spent per phase",
+           [(f'{{phase="{phase}"}}', seconds) for phase, seconds in total.phases.items()])
+
+    cumulative: int = 0
+    buckets: list[tuple[str, float]] = []
+    for bound, count in zip(CopyStats.LATENCY_BUCKETS, total.latency_buckets):
+        cumulative += count
+        buckets.append((f'_bucket{{le="{"+Inf" if bound == float("inf") else f"{bound:g}"}"}}', cumulative))
+    metric("file_seconds", "histogram", "Copy latency of a file",
+           buckets + [("_sum", total.latency_sum), ("_count", total.latency_count)])
+
+    metric("in_flight_files", "gauge", "Files being copied right now", [("", in_flight)])
+    metric("queued_files", "gauge", "Files waiting for the copy workers", [("", queued)])
+    metric("walk_done", "gauge", "1 if all the source files are discovered", [("", int(stats.walk_done))])
+    metric("elapsed_seconds", "gauge", "Time since the start of the copy run", [("", total.elapsed())])
+    return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(stats: CopyStats, host: str, port: int) -> asyncio.AbstractServer:
+    """
+    Start a minimal HTTP server exposing the counters of the copy run on /metrics.
+
+    :param stats: Counters of the copy run
+    :param host: Listening address
+    :param port: Listening port
+    :return: Started server (close it at the end of the run)
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request: list[str] = (await reader.readline()).decode("latin-1").split()
+            # Skip the request headers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if len(request) >= 2 and request[0] in ("GET", "HEAD") and request[1].split("?")[0] == "/metrics":
+                status: str = "200 OK"
+                body: bytes = render_metrics(stats).encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {METRICS_CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+            )
+            if request[:1] != ["HEAD"]:
+                writer.write(body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.debug(f"Metrics request failed: {str(e)}")
+        finally:
+            writer.close()
+
+    server: asyncio.AbstractServer = await asyncio.start_server(handle, host, port)
+    logging.info(f"Metrics are exposed on http://{host}:{port}/metrics")
+    return server
+
+
+class IOBackend:
+    """
+    Executor of the blocking file operations (listing, stat, mkdir, copy, hashing).
+
+    The default backend runs them in the default executor of the event loop.
+    """
+    name: str = "default"
+
+    def __init__(self, threads: Optional[int] = None) -> None:
+        """
+        :param threads: Number of the I/O threads (not used by the default backend)
+        """
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        """
+        Run the blocking function in the backend executor.
+
+        :param func: Blocking function
+        :param args: Function arguments
+        :return: Function result
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def close(self) -> None:
+        """
+        Release the backend resources.
+        """
+
+
+class ThreadsIOBackend(IOBackend):
+    """
+    Dedicated, separately sized thread pool for the file operations, not shared with
+    the default executor of the event loop.
+    """
+    name: str = "threads"
+
+    def __init__(self, threads: Optional[int] = None) -> None:
+        super().__init__(threads)
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads or DEFAULT_IO_THREADS, thread_name_prefix="folder-copy-io"
+        )
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+IO_BACKENDS: dict[str, type[IOBackend]] = {backend.name: backend for backend in (IOBackend, ThreadsIOBackend)}
+
+# I/O backend of the current copy run
+io_backend: ContextVar[IOBackend] = ContextVar("io_backend", default=IOBackend())
+
+
+async def run_io(func: Callable, *args: Any) -> Any:
+    """
+    Run a blocking file operation with the I/O backend of the current copy run.
+
+    :param func: Blocking function
+    :param args: Function arguments
+    :return: Function result
+    """
+    return await io_backend.get().run(func, *args)
+
+
+@contextmanager
+def use_io_backend(name: str = "default", threads: Optional[int] = None) -> Iterator[IOBackend]:
+    """
+    Use the I/O backend for the file operations of the current context.
+
+    :param name: Backend name, one of IO_BACKENDS
+    :param threads: Number of the I/O threads
+    :return: I/O backend
+    """
+    if name not in IO_BACKENDS:
+        raise ValueError(f'Unknown I/O backend: "{name}"')
+    backend: IOBackend = IO_BACKENDS[name](threads)
+    token = io_backend.set(backend)
+    try:
+        yield backend
+    finally:
+        io_backend.reset(token)
+        backend.close()
+
+
+class KeyedLock:
+    """
+    Collection of asyncio locks by key.
+
+    Only the locks which are held or awaited are kept in memory: the entry is removed
+    when its last user releases it, so the memory is bounded by the number of concurrent users.
+    """
+
+    def __init__(self) -> None:
+        # Lock and the number of its users (holder and waiters) per key
+        self._locks: dict[Hashable, list] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        """
+        Hold the lock of the key for the duration of the context.
+
+        :param key: Lock key
+        """
+        entry: Optional[list] = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+
+def copy_reflink(fd_in: int, fd_out: int, size: int) -> None:
+    """
+    Clone the file extents (copy-on-write filesystems only: Btrfs, XFS, etc.).
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "Reflink is not supported on this platform")
+    fcntl.ioctl(fd_out, FICLONE, fd_in)
+
+
+def copy_range(fd_in: int, fd_out: int, size: int) -> None:
+    """
+    Copy the file data inside the kernel with copy_file_range.
+    """
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not supported on this platform")
+    offset: int = 0
+    while offset < size:
+        copied: int = os.copy_file_range(fd_in, fd_out, size - offset, offset, offset)
+        if copied == 0:
+            break
+        offset += copied
+
+
+def copy_sendfile(fd_in: int, fd_out: int, size: int) -> None:
+    """
+    Copy the file data inside the kernel with sendfile.
+    """
+    if not hasattr(os, "sendfile"):
+        raise OSError(errno.ENOSYS, "sendfile is not supported on this platform")
+    offset: int = 0
+    while offset < size:
+        copied: int = os.sendfile(fd_out, fd_in, offset, size - offset)
+        if copied == 0:
+            break
+        offset += copied
+
+
+def copy_buffered(fd_in: int, fd_out: int, size: int) -> None:
+    """
+    Copy the file data through a user space buffer.
+    """
+    while buffer := os.read(fd_in, COPY_BUFFER_SIZE):
+        view = memoryview(buffer)
+        while view:
+            view = view[os.write(fd_out, view):]
+
+
+# Copy methods in the order they are tried by the "auto" mode
+COPY_METHODS: dict[str, Callable[[int, int, int], None]] = {
+    "reflink": copy_reflink,
+    "copy_file_range": copy_range,
+    "sendfile": copy_sendfile,
+    "buffered": copy_buffered,
+}
+COPY_MODES: list[str] = ["auto", *COPY_METHODS]
+
+
+def copy_chunk(source: str, destination: str, offset: int, length: int, copy_mode: str = "auto") -> str:
+    """
+    Copy a range of the file data to the same offset of the destination (blocking, runs in the executor).
+    The range is copied with copy_file_range, falling back to pread/pwrite ("buffered" - pread/pwrite only).
+
+    :param source: Source file
+    :param destination: Destination file (already created)
+    :param offset: Range offset
+    :param length: Range length
+    :param copy_mode: Copy mode, one of the modes allowed for the chunked copy ("auto", "copy_file_range", "buffered")
+    :return: Name of the method which copied the range
+    """
+    fd_in: int = os.open(source, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        fd_out: int = os.open(destination, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        try:
+            end: int = offset + length
+            if copy_mode != "buffered" and hasattr(os, "copy_file_range"):
+                try:
+                    position: int = offset
+                    while position < end:
+                        copied: int = os.copy_file_range(fd_in, fd_out, end - position, position, position)
+                        if copied == 0:
+                            break
+                        position += copied
+                    return "copy_file_range"
+                except OSError as e:
+                    if e.errno not in COPY_UNSUPPORTED_ERRORS:
+                        raise
+            position = offset
+            while position < end:
+                buffer: bytes = os.pread(fd_in, min(COPY_BUFFER_SIZE, end - position), position)
+                if not buffer:
+                    break
+                view = memoryview(buffer)
+                while view:
+                    written: int = os.pwrite(fd_out, view, position)
+                    view = view[written:]
+                    position += written
+            return "pread/pwrite"
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+
+
+async def copy_file_chunked(source: str, destination: str, size: int, chunk_size: int, copy_mode: str = "auto") -> str:
+    """
+    Copy a large file by ranges, in parallel executor jobs.
+
+    :param source: Source file
+    :param destination: Destination file (created or truncated)
+    :param size: Source file size
+    :param chunk_size: Size of a range
+    :param copy_mode: Copy mode, "auto" tries to reflink the whole file first
+    :return: Name of the method which copied the file
+    """
+    if copy_mode == "auto":
+        try:
+            return await run_io(copy_file_data, source, destination, "reflink")
+        except OSError as e:
+            if e.errno not in COPY_UNSUPPORTED_ERRORS:
+                raise
+
+    def prepare() -> None:
+        with open(destination, "wb") as stream:
+            stream.truncate(size)
+
+    await run_io(prepare)
+    methods: list[str] = await asyncio.gather(*[
+        run_io(copy_chunk, source, destination, offset, min(chunk_size, size - offset), copy_mode)
+        for offset in range(0, size, chunk_size)
+    ])
+    return f"{methods[0]}, {len(methods)} chunks"
+
+
+def copy_file_data(source: str, destination: str, mode: str = "auto") -> str:
+    """
+    Copy the file content (blocking, runs in the executor).
+
+    The "auto" mode tries the methods from the cheapest one (reflink) to the buffered copy,
+    falling back to the next method when the current one is not supported for the pair of files.
+
+    :param source: Source file
+    :param destination: Destination file (created or truncated)
+    :param mode: Copy mode, one of COPY_MODES
+    :return: Name of the method which copied the file
+    """
+    methods: list[str] = list(COPY_METHODS) if mode == "auto" else [mode]
+
+    fd_in: int = os.open(source, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        size: int = os.fstat(fd_in).st_size
+        fd_out: int = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+        try:
+            for method in methods:
+                try:
+                    COPY_METHODS[method](fd_in, fd_out, size)
+                    return method
+                except OSError as e:
+                    if method == methods[-1] or e.errno not in COPY_UNSUPPORTED_ERRORS:
+                        raise
+                    # Start the next method from scratch
+                    os.ftruncate(fd_out, 0)
+                    os.lseek(fd_out, 0, os.SEEK_SET)
+                    os.lseek(fd_in, 0, os.SEEK_SET)
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+
+
+# Ways to materialize the sorted tree: physical copies, links to the source files or the source files moved
+LINK_MODES: list[str] = ["copy", "hardlink", "symlink", "reflink", "move"]
+
+
+def remove_file(path: str) -> None:
+    """
+    Remove the file if it exists (blocking, runs in the executor).
+
+    :param path: File path
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def reserve_file(path: str) -> None:
+    """
+    Atomically create an empty file, claiming its name (blocking, runs in the executor).
+    Fails with FileExistsError if the name is already taken, including by another process.
+
+    :param path: File path
+    """
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666))
+
+
+def temporary_path(path: str) -> str:
+    """
+    :param path: File path
+    :return: Unique temporary file path next to the file, to be renamed over it
+    """
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+
+def replace_with_link(link: Callable[[str, str], None], source: str, destination: str) -> None:
+    """
+    Replace the (reserved) destination file with a link to the source file.
+
+    The link is created under a temporary name and renamed over the destination,
+    so the destination name is never released.
+
+    :param link: Link function (os.link or os.symlink)
+    :param source: Source file
+    :param destination: Destination file
+    """
+    temporary: str = temporary_path(destination)
+    link(source, temporary)
+    try:
+        os.replace(temporary, destination)
+    except OSError:
+        os.unlink(temporary)
+        raise
+
+
+def move_file(source: str, destination: str, copy_mode: str = "auto") -> str:
+    """
+    Move the source file over the (reserved) destination file.
+
+    On the same filesystem the file is renamed (metadata only), across filesystems
+    it is copied, the copy is verified against the source and the source is removed.
+
+    :param source: Source file
+    :param destination: Destination file
+    :param copy_mode: Copy mode of the cross-device move, one of COPY_MODES
+    :return: Name of the method which moved the file
+    """
+    try:
+        os.replace(source, destination)
+        return "rename"
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    method: str = copy_file_data(source, destination, copy_mode)
+    if os.stat(source).st_size != os.stat(destination).st_size or hash_file(source) != hash_file(destination):
+        raise OSError(errno.EIO, "The copy differs from the source file, the source file is kept", destination)
+    os.unlink(source)
+    return f"{method}+unlink"
+
+
+def place_files(jobs: list[tuple[str, str, bool]], link_mode: str = "copy", copy_mode: str = "auto") -> list:
+    """
+    Materialize a batch of source files (blocking, runs in the executor as one job).
+
+    :param jobs: Source file, destination file and the flag to claim the destination name first
+                 (otherwise the existing destination is replaced)
+    :param link_mode: Link mode, one of LINK_MODES
+    :param copy_mode: Copy mode of the "copy" link mode, one of COPY_MODES
+    :return: Per job: the name of the method which placed the file, or the error
+    """
+    results: list = []
+    for source, destination, claim in jobs:
+        try:
+            if claim:
+                reserve_file(destination)
+                results.append(place_file(source, destination, link_mode, copy_mode))
+            else:
+                results.append(replace_file(source, destination, link_mode, copy_mode))
+        except OSError as e:
+            results.append(e)
+    return results
+
+
+def replace_file(source: str, destination: str, link_mode: str = "copy", copy_mode: str = "auto") -> str:
+    """
+    Materialize the source file over an existing destination file (blocking, runs in the executor).
+
+    The file is placed under a temporary name and renamed over the destination, so the destination
+    is never truncated in place: its other hard links keep their content.
+
+    :param source: Source file
+    :param destination: Destination file
+    :param link_mode: Link mode, one of LINK_MODES
+    :param copy_mode: Copy mode of the "copy" link mode, one of COPY_MODES
+    :return: Name of the method which placed the file
+    """
+    temporary: str = temporary_path(destination)
+    try:
+        method: str = place_file(source, temporary, link_mode, copy_mode)
+        os.replace(temporary, destination)
+        return method
+    except OSError:
+        if os.path.lexists(source):
+            # The temporary file is kept if it is the only one left of a moved file
+            remove_file(temporary)
+        raise
+
+
+def place_file(source: str, destination: str, link_mode: str = "copy", copy_mode: str = "auto") -> str:
+    """
+    Materialize the source file at the destination path (blocking, runs in the executor).
+    The destination may already exist as a reserved empty file, it is overwritten.
+
+    :param source: Source file
+    :param destination: Destination file
+    :param link_mode: Link mode, one of LINK_MODES
+    :param copy_mode: Copy mode of the "copy" link mode, one of COPY_MODES
+    :return: Name of the method which placed the file
+    """
+    if link_mode == "hardlink":
+        replace_with_link(os.link, source, destination)
+        return "hardlink"
+    if link_mode == "symlink":
+        replace_with_link(os.symlink, source, destination)
+        return "symlink"
+    if link_mode == "reflink":
+        return copy_file_data(source, destination, "reflink")
+    if link_mode == "move":
+        return move_file(source, destination, copy_mode)
+    return copy_file_data(source, destination, copy_mode)
 
 
 async def get_absolute_path(
@@ -20,146 +908,2454 @@ async def get_absolute_path(
         current_dir: Optional[Union[AsyncPath, str]] = None,
 ) -> AsyncPath:
     """
-    Return the absolute path for the given path and the current directory.
+    Return the absolute path for the given path and the current directory.
+
+    :param path: specified path (str, Path, mandatory)
+    :param current_dir: current directory (str, Path, optional)
+    :return: absolute path (Path)
+    """
+    if not path:
+        # The path can not be None or an empty string
+        raise ValueError('The path can not be empty')
+
+    if AsyncPath(path).is_absolute():
+        # If the specified path is an absolute - return it
+        return AsyncPath(path)
+
+    if current_dir is not None and isinstance(current_dir, str):
+        # If the current directory is not specified, use the current working directory
+        current_dir = AsyncPath(current_dir)
+
+    # Construct an absolute path and return
+    return (current_dir if current_dir is not None else await AsyncPath.cwd()) / path
+
+
+def list_names(folder: str) -> set[str]:
+    """
+    Read the names of the folder entries (blocking, runs in the executor).
+
+    :param folder: Folder
+    :return: Set of the entry names (empty if the folder does not exist)
+    """
+    try:
+        return set(os.listdir(folder))
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
+class NameRegistry:
+    """
+    In-memory registry of the file names used in the destination folders.
+
+    Every folder is listed once, on the first use; after that the next free name
+    "name (n).ext" is handed out without any filesystem probing.
+    """
+
+    def __init__(self, stats: Optional[CopyStats] = None) -> None:
+        """
+        :param stats: Counters of the copy run, the collisions are counted there too (optional)
+        """
+        self.stats: Optional[CopyStats] = stats
+        # Used names per destination folder
+        self._names: dict[str, set[str]] = {}
+        # Next copy index per destination folder and base file name
+        self._indexes: dict[tuple[str, str], int] = {}
+        # Folders being listed right now
+        self._loading: dict[str, asyncio.Future] = {}
+        # Number of the names which got a copy index because the base name was taken
+        self.collisions: int = 0
+
+    async def names(self, folder: str) -> set[str]:
+        """
+        Return the set of the names used in the folder, listing the folder on the first call.
+
+        :param folder: Destination folder
+        :return: Set of the used names (shared, changed by claim)
+        """
+        if (names := self._names.get(folder)) is not None:
+            return names
+
+        if (loading := self._loading.get(folder)) is None:
+            loading = asyncio.ensure_future(run_io(list_names, folder))
+            self._loading[folder] = loading
+        try:
+            listed: set[str] = await asyncio.shield(loading)
+        finally:
+            if loading.done():
+                self._loading.pop(folder, None)
+        return self._names.setdefault(folder, listed)
+
+    async def claim(self, folder: AsyncPath, stem: str, extension: str) -> AsyncPath:
+        """
+        Reserve a free file name in the folder.
+
+        :param folder: Destination folder
+        :param stem: File name without the extension
+        :param extension: File extension (without the leading dot)
+        :return: Absolute path with the reserved name
+        """
+        key: str = os.fspath(folder)
+        names: set[str] = await self.names(key)
+
+        # No awaits below - the name check and the reservation are atomic for the event loop
+        index: int = self._indexes.get((key, f"{stem}.{extension}"), 0)
+        name: str = f"{stem}.{extension}" if index == 0 else f"{stem} ({index}).{extension}"
+        while name in names:
+            index += 1
+            # Build a new file name with index of copy
+            name = f"{stem} ({index}).{extension}"
+
+        names.add(name)
+        self._indexes[(key, f"{stem}.{extension}")] = index + 1
+        if index > 0:
+            self.collisions += 1
+            if self.stats is not None:
+                self.stats.collisions += 1
+        return folder / name
+
+
+class FolderCache:
+    """
+    Destination folders created during the run: every folder is created once,
+    concurrent requests for the same folder wait for the same creation.
+    """
+
+    def __init__(self) -> None:
+        self._folders: dict[str, asyncio.Future] = {}
+
+    async def ensure(self, folder: AsyncPath) -> None:
+        """
+        Create the folder (with parents) if it has not been created yet.
+
+        :param folder: Destination folder
+        """
+        key: str = os.fspath(folder)
+        if (creating := self._folders.get(key)) is None:
+            creating = asyncio.ensure_future(run_io(functools.partial(os.makedirs, key, exist_ok=True)))
+            self._folders[key] = creating
+        try:
+            await asyncio.shield(creating)
+        except OSError:
+            self.forget(folder)
+            raise
+
+    def __contains__(self, folder: str) -> bool:
+        """
+        :param folder: Folder path
+        :return: True if the folder is a destination folder of the run (created by it or already existing)
+        """
+        return folder in self._folders
+
+    def forget(self, folder: AsyncPath) -> None:
+        """
+        Forget the folder, e.g. when it has been removed, the next ensure creates it again.
+
+        :param folder: Destination folder
+        """
+        self._folders.pop(os.fspath(folder), None)
+
+
+# Default size classes of the routing templates: name and upper bound (None - unbounded)
+SIZE_CLASSES: tuple[tuple[str, Optional[int]], ...] = (
+    ("tiny", 64 * 1024), ("small", 1024 ** 2), ("medium", 100 * 1024 ** 2), ("large", 1024 ** 3), ("huge", None),
+)
+
+# Default destination template: a folder per extension
+DEFAULT_ROUTE: str = "{ext}"
+
+
+class RoutingRules:
+    """
+    Routing of the files to the destination folders by extension, glob or regular expression.
+
+    The rules are compiled once: the extension sets into a dictionary and the globs and regular expressions
+    into a single combined regular expression, so the routing of a file does not depend on the number of rules.
+    The regular expressions which cannot be combined (with groups referenced by number or by name,
+    or with global inline flags) are matched one by one.
+    The first matching rule wins, the files matching no rule get the default template.
+
+    The templates are folders relative to the destination, with the placeholders {ext}, {name}, {stem},
+    {year}, {month}, {day} (of the modification time) and {size_class}.
+    """
+
+    # Numbered backreferences and global inline flags break when the expression is a part of a combined one
+    NOT_COMBINABLE: re.Pattern = re.compile(r"\\[1-9]|\(\?[aiLmsux]+\)")
+
+    # Placeholder values which would escape the routed folder, replaced with underscores
+    UNSAFE_VALUES: tuple[str, ...] = (".", "..")
+
+    def __init__(
+            self,
+            rules: list[dict],
+            default: str = DEFAULT_ROUTE,
+            size_classes: tuple[tuple[str, Optional[int]], ...] = SIZE_CLASSES,
+    ) -> None:
+        """
+        :param rules: Rules in priority order: {"extensions": [...] | "glob": ... | "regex": ..., "destination": ...}
+                      (the extensions and the globs are case-insensitive, the regular expressions are not)
+        :param default: Template of the files matching no rule
+        :param size_classes: Size classes in ascending order: name and upper bound (None - unbounded)
+        """
+        if not size_classes or size_classes[-1][1] is not None:
+            raise ValueError('The last size class must be unbounded')
+        self.size_classes: tuple[tuple[str, Optional[int]], ...] = size_classes
+        self.default: str = self.check_template(default)
+        self.templates: list[str] = []
+        # Extension (lower case, without the dot) -> index of the first rule with it
+        self.extensions: dict[str, int] = {}
+        # Index of the first pattern rule: the extension rules before it need no pattern matching
+        self.first_pattern: int = len(rules)
+        patterns: list[str] = []
+        # Regular expressions matched one by one: rule index and expression
+        self.separate: list[tuple[int, re.Pattern]] = []
+        for index, rule in enumerate(rules):
+            self.templates.append(self.check_template(rule.get("destination", "")))
+            if "extensions" in rule:
+                for extension in rule["extensions"]:
+                    self.extensions.setdefault(extension.lower().lstrip("."), index)
+            elif "glob" in rule:
+                self.first_pattern = min(self.first_pattern, index)
+                patterns.append(f"(?P<rule_{index}>(?i:{fnmatch.translate(rule['glob'])}))")
+            elif "regex" in rule:
+                self.first_pattern = min(self.first_pattern, index)
+                regex: re.Pattern = re.compile(rule["regex"])
+                if regex.groupindex or self.NOT_COMBINABLE.search(rule["regex"]):
+                    self.separate.append((index, regex))
+                else:
+                    patterns.append(f"(?P<rule_{index}>(?s:.*?)(?:{rule['regex']}))")
+            else:
+                raise ValueError(f'Rule {index + 1} has no "extensions", "glob" or "regex"')
+        # Alternatives are tried in order - the match is the first matching pattern rule
+        self.pattern: Optional[re.Pattern] = re.compile("|".join(patterns)) if patterns else None
+
+    def check_template(self, template: str) -> str:
+        """
+        Check that the template is a relative folder with known placeholders only.
+
+        :param template: Destination template
+        :return: The template
+        """
+        try:
+            folder: str = template.format(
+                ext="ext", name="name", stem="stem", year="2000", month="01", day="01", size_class="tiny"
+            )
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f'Invalid destination template "{template}": {str(e)}')
+        if not self.is_relative(folder):
+            raise ValueError(f'The destination template must be a relative folder: "{template}"')
+        return template
+
+    @staticmethod
+    def is_relative(folder: str) -> bool:
+        """
+        :param folder: Folder
+        :return: True if the folder is a non-empty relative path without "." and ".." segments
+        """
+        return bool(folder) and not os.path.isabs(folder) and not any(
+            part in (".", "..") for part in folder.replace("\\", "/").split("/")
+        )
+
+    def size_class(self, size: int) -> str:
+        """
+        :param size: File size
+        :return: Name of the size class
+        """
+        for name, limit in self.size_classes:
+            if limit is None or size < limit:
+                return name
+        return self.size_classes[-1][0]
+
+    def folder(self, name: str, size: int = 0, mtime_ns: int = 0) -> str:
+        """
+        Route a file to its destination folder.
+
+        :param name: File name
+        :param size: File size
+        :param mtime_ns: File modification time, nanoseconds
+        :return: Destination folder relative to the destination root
+        """
+        stem, dot, extension = name.rpartition(".")
+        if not dot or not stem:
+            stem, extension = name, ""
+        index: Optional[int] = self.extensions.get(extension.lower())
+        if (index is None or index > self.first_pattern) and self.pattern is not None:
+            if (match := self.pattern.match(name)) is not None:
+                matched: int = int(match.lastgroup[len("rule_"):])
+                index = matched if index is None else min(index, matched)
+        for rule_index, regex in self.separate:
+            if index is not None and rule_index > index:
+                break
+            if regex.search(name) is not None:
+                index = rule_index
+                break
+        template: str = self.templates[index] if index is not None else self.default
+
+        values: dict[str, str] = {"ext": extension or "without_extension", "name": name, "stem": stem}
+        for key, value in values.items():
+            if value in self.UNSAFE_VALUES:
+                values[key] = "_" * len(value)
+        if "{year" in template or "{month" in template or "{day" in template:
+            modified: time.struct_time = time.localtime(mtime_ns / 1e9)
+            values.update(year=f"{modified.tm_year:04d}", month=f"{modified.tm_mon:02d}", day=f"{modified.tm_mday:02d}")
+        values["size_class"] = self.size_class(size)
+        folder: str = template.format(**values)
+        if not self.is_relative(folder):
+            # The values combined into an unsafe path, e.g. "{stem}." for the file ".."
+            raise ValueError(f'The destination folder "{folder}" of the file "{name}" is not a relative folder')
+        return folder
+
+
+def load_routes(path: str) -> RoutingRules:
+    """
+    Load the routing rules from a JSON file:
+    {"rules": [{"extensions": ["jpg", "png"], "destination": "images/{year}"}, {"glob": "*.tar.gz", ...},
+    {"regex": "^IMG_\\d+", ...}], "default": "{ext}", "size_classes": {"small": "1M", "medium": "100M", "large": null}}.
+
+    :param path: Rules file
+    :return: Compiled rules
+    """
+    with open(path, encoding="utf-8") as rules_file:
+        config: dict = json.load(rules_file)
+    size_classes: tuple[tuple[str, Optional[int]], ...] = SIZE_CLASSES
+    if "size_classes" in config:
+        try:
+            size_classes = tuple(
+                (name, parse_size(limit) if isinstance(limit, str) else limit)
+                for name, limit in config["size_classes"].items()
+            )
+        except argparse.ArgumentTypeError as e:
+            raise ValueError(str(e))
+    try:
+        return RoutingRules(config.get("rules", []), config.get("default", DEFAULT_ROUTE), size_classes)
+    except re.error as e:
+        raise ValueError(f'Invalid regular expression in the routing rules: {str(e)}')
+
+
+def destination_folder(
+        file: AsyncPath,
+        dest: AsyncPath,
+        router: Optional[RoutingRules] = None,
+        size: int = 0,
+        mtime_ns: int = 0,
+) -> AsyncPath:
+    """
+    Choose the destination folder of the file
+
+    :param file: Absolute path of the existing file
+    :param dest: Destination folder
+    :param router: Routing rules of the destination folders (optional, by default a folder per extension)
+    :param size: Source file size (for the routing templates)
+    :param mtime_ns: Source file modification time, nanoseconds (for the routing templates)
+    :return: Destination folder of the file
+    """
+    if router is not None:
+        return dest / router.folder(file.name, size, mtime_ns)
+    file_extension: str = file.suffix[1:] if file.suffix.startswith(".") else file.suffix
+    return dest / (file_extension or "without_extension")
+
+
+async def file_path_build(
+        file: AsyncPath,
+        dest: AsyncPath,
+        registry: Optional[NameRegistry] = None,
+        router: Optional[RoutingRules] = None,
+        size: int = 0,
+        mtime_ns: int = 0,
+) -> AsyncPath:
+    """
+    Build a new file name based on the destination folder and file extension
+
+    :param file: Absolute path of the existing file
+    :param dest: Destination folder
+    :param registry: Registry of the used names (optional, without it the names are probed on disk)
+    :param router: Routing rules of the destination folders (optional, by default a folder per extension)
+    :param size: Source file size (for the routing templates)
+    :param mtime_ns: Source file modification time, nanoseconds (for the routing templates)
+    :return: New file absolute path
+    """
+
+    # Build a new file name based on the destination folder and file extension
+    file_extension: str = file.suffix[1:] if file.suffix.startswith(".") else file.suffix
+    file_name: str = file.stem
+    folder: AsyncPath = destination_folder(file, dest, router, size, mtime_ns)
+
+    if registry is not None:
+        return await registry.claim(folder, file_name, file_extension)
+
+    new_file_name: AsyncPath = folder / f"{file_name}.{file_extension}"
+
+    # Verify if a file with the same name already exists
+    rename_tries: int = 0
+    while await new_file_name.exists():
+        rename_tries += 1
+        # Build a new file name with index of copy
+        new_file_name = new_file_name.with_stem(f"{file_name} ({rename_tries})")
+
+    return new_file_name
+
+
+class SourceFile(NamedTuple):
+    """
+    Regular file found by the folder walk.
+    """
+    path: AsyncPath
+    size: int
+    mtime_ns: int
+    # Device and inode of a file with several hard links (None - a single link)
+    inode: Optional[tuple[int, int]] = None
+
+
+class PlannedFile(NamedTuple):
+    """
+    Source file with the destination chosen in advance (copy plan).
+    """
+    path: AsyncPath
+    size: int
+    mtime_ns: int
+    destination: AsyncPath
+
+
+class WalkFilter:
+    """
+    Filters of the folder walk, evaluated on the directory entries during the scan:
+    the excluded and too deep folders are never listed, the excluded file names are not even stat'ed.
+
+    The glob patterns match the entry name, or the path relative to the source folder if they contain "/".
+    """
+
+    def __init__(
+            self,
+            source_folder: str,
+            include: Optional[list[str]] = None,
+            exclude: Optional[list[str]] = None,
+            max_depth: Optional[int] = None,
+            min_size: Optional[int] = None,
+            max_size: Optional[int] = None,
+            newer_than: Optional[float] = None,
+            prune: Optional[list[str]] = None,
+            destinations: Optional[Container[str]] = None,
+    ) -> None:
+        """
+        :param source_folder: Source folder (absolute)
+        :param include: Copy only the files matching one of the glob patterns (None - all the files)
+        :param exclude: Skip the files and the folders matching one of the glob patterns
+        :param max_depth: Maximum depth of the scanned subfolders (0 - the source folder only, None - unlimited)
+        :param min_size: Skip the files smaller than this size
+        :param max_size: Skip the files larger than this size
+        :param newer_than: Skip the files modified before this time, seconds since the epoch
+        :param prune: Folders which are not scanned and files which are skipped, e.g. the destination
+                      inside the source (absolute)
+        :param destinations: Destination folders of the run, which are not scanned either (absolute, checked
+                             during the walk, as they appear when the destination is the source folder itself)
+        """
+        if max_depth is not None and max_depth < 0:
+            raise ValueError('The maximum depth must not be negative')
+        self.root: str = source_folder.rstrip(os.sep)
+        self.include: Optional[tuple[Optional[re.Pattern], Optional[re.Pattern]]] = (
+            self.compile(include) if include else None
+        )
+        self.exclude: Optional[tuple[Optional[re.Pattern], Optional[re.Pattern]]] = (
+            self.compile(exclude) if exclude else None
+        )
+        self.max_depth: Optional[int] = max_depth
+        self.min_size: Optional[int] = min_size
+        self.max_size: Optional[int] = max_size
+        self.newer_than_ns: Optional[int] = int(newer_than * 1e9) if newer_than is not None else None
+        self.prune: set[str] = set(prune or ())
+        self.destinations: Optional[Container[str]] = destinations
+
+    @staticmethod
+    def compile(patterns: list[str]) -> tuple[Optional[re.Pattern], Optional[re.Pattern]]:
+        """
+        Compile the glob patterns into a single regular expression for the names and one for the relative paths.
+
+        :param patterns: Glob patterns
+        :return: Name and path regular expressions (None - no such patterns)
+        """
+        names: list[str] = [fnmatch.translate(pattern) for pattern in patterns if "/" not in pattern]
+        paths: list[str] = [fnmatch.translate(pattern.strip("/")) for pattern in patterns if "/" in pattern]
+        return (
+            re.compile("|".join(names)) if names else None,
+            re.compile("|".join(paths)) if paths else None,
+        )
+
+    def matches(self, patterns: tuple[Optional[re.Pattern], Optional[re.Pattern]], entry: os.DirEntry) -> bool:
+        """
+        :param patterns: Name and path regular expressions
+        :param entry: Directory entry
+        :return: True if the entry matches one of the patterns
+        """
+        names, paths = patterns
+        if names is not None and names.match(entry.name):
+            return True
+        if paths is not None:
+            relative: str = entry.path[len(self.root) + 1:]
+            return paths.match(relative if os.sep == "/" else relative.replace(os.sep, "/")) is not None
+        return False
+
+    def accepts_folder(self, entry: os.DirEntry, depth: int) -> bool:
+        """
+        :param entry: Directory entry of a subfolder
+        :param depth: Depth of the subfolder (1 - in the source folder)
+        :return: True if the subfolder must be scanned
+        """
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        if entry.path in self.prune or (self.destinations is not None and entry.path in self.destinations):
+            return False
+        return self.exclude is None or not self.matches(self.exclude, entry)
+
+    def accepts_name(self, entry: os.DirEntry) -> bool:
+        """
+        :param entry: Directory entry of a file
+        :return: True if the file name passes the include and exclude patterns
+        """
+        if entry.path in self.prune:
+            return False
+        if self.exclude is not None and self.matches(self.exclude, entry):
+            return False
+        return self.include is None or self.matches(self.include, entry)
+
+    def accepts_stat(self, stat: os.stat_result) -> bool:
+        """
+        :param stat: File status
+        :return: True if the file passes the size and modification time filters
+        """
+        return (
+            (self.min_size is None or stat.st_size >= self.min_size)
+            and (self.max_size is None or stat.st_size <= self.max_size)
+            and (self.newer_than_ns is None or stat.st_mtime_ns >= self.newer_than_ns)
+        )
+
+
+class ScanBatch(NamedTuple):
+    """
+    Batch of directory entries classified by the folder scan.
+    """
+    folders: list[str]
+    files: list[SourceFile]
+    skipped: list[str]
+    done: bool
+    # Entries left out by the walk filter
+    filtered: int = 0
+    # Symbolic links which are not followed
+    links: int = 0
+
+
+def scan_batch(
+        entries: Iterator[os.DirEntry],
+        batch_size: int,
+        walk_filter: Optional[WalkFilter] = None,
+        depth: int = 0,
+        follow_symlinks: bool = False,
+) -> ScanBatch:
+    """
+    Read the next batch of directory entries (blocking, runs in the executor).
+    The entry type is taken from the cached DirEntry information, the only extra syscall is a stat of regular files.
+
+    :param entries: Open directory iterator (os.scandir)
+    :param batch_size: Maximum number of entries to read
+    :param walk_filter: Filters of the walk (optional)
+    :param depth: Depth of the scanned folder (0 - the source folder)
+    :param follow_symlinks: Follow the symbolic links to files and folders, otherwise skip them
+    :return: Classified batch of entries
+    """
+    folders: list[str] = []
+    files: list[SourceFile] = []
+    skipped: list[str] = []
+    filtered: int = 0
+    links: int = 0
+    count: int = 0
+
+    for entry in itertools.islice(entries, batch_size):
+        count += 1
+        try:
+            if not follow_symlinks and entry.is_symlink():
+                links += 1
+            elif entry.is_dir():
+                if walk_filter is None or walk_filter.accepts_folder(entry, depth + 1):
+                    folders.append(entry.path)
+                else:
+                    filtered += 1
+            elif entry.is_file():
+                if walk_filter is not None and not walk_filter.accepts_name(entry):
+                    filtered += 1
+                    continue
+                stat: os.stat_result = entry.stat()
+                if walk_filter is not None and not walk_filter.accepts_stat(stat):
+                    filtered += 1
+                    continue
+                files.append(SourceFile(
+                    AsyncPath(entry.path), stat.st_size, stat.st_mtime_ns,
+                    (stat.st_dev, stat.st_ino) if stat.st_nlink > 1 else None,
+                ))
+            else:
+                skipped.append(entry.path)
+        except OSError:
+            # The entry disappeared or is not accessible
+            skipped.append(entry.path)
+
+    return ScanBatch(folders, files, skipped, count < batch_size, filtered, links)
+
+
+async def scan_folder(
+        folder: str,
+        batch_size: int = DEFAULT_SCAN_BATCH_SIZE,
+        stats: Optional[CopyStats] = None,
+        walk_filter: Optional[WalkFilter] = None,
+        depth: int = 0,
+        follow_symlinks: bool = False,
+) -> AsyncIterator[ScanBatch]:
+    """
+    Asynchronously scan a single folder with os.scandir, yielding the entries in batches.
+    Each batch costs one executor call instead of one call per entry.
+
+    :param folder: Folder for scan
+    :param batch_size: Number of entries per batch
+    :param stats: Counters of the copy run, the scan time is added to the "walk" phase (optional)
+    :param walk_filter: Filters of the walk (optional)
+    :param depth: Depth of the folder (0 - the source folder)
+    :param follow_symlinks: Follow the symbolic links to files and folders, otherwise skip them
+    :return: Asynchronous iterator of the entry batches
+    """
+    if stats is None:
+        stats = CopyStats()
+    with stats.timed("walk"):
+        entries = await run_io(os.scandir, folder)
+    try:
+        while True:
+            with stats.timed("walk"):
+                batch: ScanBatch = await run_io(scan_batch, entries, batch_size, walk_filter, depth, follow_symlinks)
+            yield batch
+            if batch.done:
+                break
+    finally:
+        entries.close()
+
+
+async def iter_folder(
+        source_folder: AsyncPath,
+        walkers: int = DEFAULT_WALKERS,
+        batch_size: int = DEFAULT_SCAN_BATCH_SIZE,
+        stats: Optional[CopyStats] = None,
+        walk_filter: Optional[WalkFilter] = None,
+        follow_symlinks: bool = False,
+) -> AsyncIterator[SourceFile]:
+    """
+    Asynchronously iterates through all files in a folder and its subfolders,
+    yielding the files as soon as they are found.
+
+    The traversal is iterative: the found subfolders are put into a work queue,
+    which is processed by several concurrent walkers.
+
+    :param source_folder: Folder for iterate
+    :param walkers: Number of folders scanned concurrently
+    :param batch_size: Number of directory entries processed by one executor call
+    :param stats: Counters of the copy run (optional)
+    :param walk_filter: Filters of the walk, the filtered out folders are not scanned (optional)
+    :param follow_symlinks: Follow the symbolic links to files and folders (every folder is scanned once,
+                            so the link loops are cut), otherwise skip them
+    :return: Asynchronous iterator of files
+    """
+    if walkers < 1:
+        raise ValueError('The number of walkers must be positive')
+    if stats is None:
+        stats = CopyStats()
+
+    # Folders waiting for the scan with their depth, the stop marker is None
+    folders: asyncio.Queue = asyncio.Queue()
+    # Batches of the found files, the end marker is None
+    found: asyncio.Queue = asyncio.Queue(maxsize=walkers * 2)
+    # Device and inode of the scanned folders (following the links only)
+    visited: set[tuple[int, int]] = set()
+
+    async def walk() -> None:
+        while True:
+            item: Optional[tuple[str, int]] = await folders.get()
+            folder: Optional[str] = item[0] if item is not None else None
+            try:
+                if item is None:
+                    return
+                depth: int = item[1]
+                if follow_symlinks:
+                    with stats.timed("walk"):
+                        folder_stat: os.stat_result = await run_io(os.stat, folder)
+                    if (folder_stat.st_dev, folder_stat.st_ino) in visited:
+                        # Link loop or a folder linked twice
+                        logging.warning(f"Skip already scanned folder: {folder}")
+                        continue
+                    visited.add((folder_stat.st_dev, folder_stat.st_ino))
+                logging.debug("Process folder: %s", folder)
+                stats.folders += 1
+                async for batch in scan_folder(folder, batch_size, stats, walk_filter, depth, follow_symlinks):
+                    stats.filtered += batch.filtered
+                    stats.links += batch.links
+                    for path in batch.skipped:
+                        # devices, sockets, FIFOs, broken links, etc. — ignore them
+                        logging.warning(f"Skip non-regular: {path}")
+                    for subfolder in batch.folders:
+                        folders.put_nowait((subfolder, depth + 1))
+                    if batch.files:
+                        for file in batch.files:
+                            stats.found(file.size)
+                        await found.put(batch.files)
+            except Exception as e:
+                logging.error(f"Failed to process folder \"{folder}\": {str(e)}")
+            finally:
+                folders.task_done()
+
+    async def supervise() -> None:
+        tasks: list[asyncio.Task] = [asyncio.create_task(walk()) for _ in range(walkers)]
+        try:
+            # All the folders (including the discovered ones) are scanned
+            await folders.join()
+            for _ in tasks:
+                folders.put_nowait(None)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        stats.walk_done = True
+        await found.put(None)
+
+    folders.put_nowait((os.fspath(source_folder), 0))
+    supervisor: asyncio.Task = asyncio.create_task(supervise())
+    try:
+        while (files := await found.get()) is not None:
+            for file in files:
+                yield file
+    finally:
+        supervisor.cancel()
+        await asyncio.gather(supervisor, return_exceptions=True)
+
+
+async def read_folder(source_folder: AsyncPath) -> list[AsyncPath]:
+    """
+    Asynchronously and recursively iterates through all files in a folder and its subfolders,
+    returning a list of the files found.
+
+    :param source_folder: Folder for iterate
+    :return: List of files
+    """
+    return [file.path async for file in iter_folder(source_folder)]
+
+
+class ManifestRecord(NamedTuple):
+    """
+    Manifest record of a source file.
+    """
+    destination: str
+    size: Optional[int]
+    mtime_ns: Optional[int]
+    done: bool
+    # Source file whose copy represents this skipped duplicate (None - the destination is the own copy)
+    original: Optional[str] = None
+    # Modification time of the original source file when the duplicate was found
+    original_mtime_ns: Optional[int] = None
 
-    :param path: specified path (str, Path, mandatory)
-    :param current_dir: current directory (str, Path, optional)
-    :return: absolute path (Path)
+
+class CopyManifest:
     """
-    if not path:
-        # The path can not be None or an empty string
-        raise ValueError('The path can not be empty')
+    Persistent (SQLite) manifest of the copied files, keyed by the source path.
 
-    if AsyncPath(path).is_absolute():
-        # If the specified path is an absolute - return it
-        return AsyncPath(path)
+    A record is created as pending when the destination is claimed and is marked done,
+    with the source size and modification time, after the copy. The next run skips
+    the unchanged done files and reuses the destinations of the pending and changed ones.
+    A skipped duplicate is recorded with the copy of its original file, which is never reused:
+    the duplicate is up to date while both files are unchanged and goes through the deduplication again otherwise.
+    """
 
-    if current_dir is not None and isinstance(current_dir, str):
-        # If the current directory is not specified, use the current working directory
-        current_dir = AsyncPath(current_dir)
+    # Columns added after the first version of the manifest, with their types
+    COLUMNS: dict[str, str] = {"original": "TEXT", "original_mtime_ns": "INTEGER"}
 
-    # Construct an absolute path and return
-    return (current_dir if current_dir is not None else await AsyncPath.cwd()) / path
+    def __init__(self, path: str) -> None:
+        """
+        :param path: Manifest database file
+        """
+        self.path: str = path
+        self._connection: sqlite3.Connection = sqlite3.connect(path, timeout=60)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS copies ("
+            "source TEXT PRIMARY KEY, destination TEXT NOT NULL, size INTEGER, mtime_ns INTEGER, done INTEGER NOT NULL)"
+        )
+        # Add the later columns, to a new manifest as well as to a manifest of an older version
+        columns: set[str] = {row[1] for row in self._connection.execute("PRAGMA table_info(copies)")}
+        for name, kind in self.COLUMNS.items():
+            if name not in columns:
+                self._connection.execute(f"ALTER TABLE copies ADD COLUMN {name} {kind}")
+        self._connection.commit()
+        self._changes: int = 0
+        self._committed_at: float = time.monotonic()
+
+    def lookup(self, source: str) -> Optional[ManifestRecord]:
+        """
+        :param source: Source file
+        :return: Manifest record of the source file, None if the file has never been copied
+        """
+        row = self._connection.execute(
+            "SELECT destination, size, mtime_ns, done, original, original_mtime_ns FROM copies WHERE source = ?",
+            (source,),
+        ).fetchone()
+        return ManifestRecord(row[0], row[1], row[2], bool(row[3]), row[4], row[5]) if row is not None else None
+
+    def start(
+            self, source: str, destination: str, original: Optional[str] = None, original_mtime_ns: Optional[int] = None
+    ) -> None:
+        """
+        Record the claimed destination of a source file (pending copy).
+
+        :param source: Source file
+        :param destination: Destination file
+        :param original: Source file whose copy is the destination (skipped duplicate, None - the own copy)
+        :param original_mtime_ns: Modification time of the original source file
+        """
+        self._connection.execute(
+            "INSERT OR REPLACE INTO copies (source, destination, size, mtime_ns, done, original, original_mtime_ns) "
+            "VALUES (?, ?, NULL, NULL, 0, ?, ?)",
+            (source, destination, original, original_mtime_ns),
+        )
+        self._changed()
+
+    def finish(self, source: str, size: int, mtime_ns: int) -> None:
+        """
+        Mark the copy of a source file as done.
+
+        :param source: Source file
+        :param size: Size of the copied source file
+        :param mtime_ns: Modification time of the copied source file
+        """
+        self._connection.execute(
+            "UPDATE copies SET size = ?, mtime_ns = ?, done = 1 WHERE source = ?", (size, mtime_ns, source)
+        )
+        self._changed()
+
+    def _changed(self) -> None:
+        self._changes += 1
+        if self._changes >= MANIFEST_COMMIT_CHANGES or time.monotonic() - self._committed_at >= MANIFEST_COMMIT_SECONDS:
+            self.commit()
 
+    def commit(self) -> None:
+        """
+        Commit the pending changes.
+        """
+        self._connection.commit()
+        self._changes = 0
+        self._committed_at = time.monotonic()
 
-async def file_path_build(file: AsyncPath, dest: AsyncPath) -> AsyncPath:
+    def close(self) -> None:
+        """
+        Commit the pending changes and close the manifest.
+        """
+        self.commit()
+        self._connection.close()
+
+
+def hash_file(path: str, limit: Optional[int] = None) -> bytes:
     """
-    Build a new file name based on the destination folder and file extension
+    Hash the file content (blocking, runs in the executor).
 
-    :param file: Absolute path of the existing file
-    :param dest: Destination folder
-    :return: New file absolute path
+    :param path: File path
+    :param limit: Number of the leading bytes to hash (None - the whole file)
+    :return: Content digest
     """
+    digest = hashlib.blake2b()
+    remaining: Optional[int] = limit
+    with open(path, "rb") as stream:
+        while remaining is None or remaining > 0:
+            chunk: bytes = stream.read(COPY_BUFFER_SIZE if remaining is None else min(remaining, COPY_BUFFER_SIZE))
+            if not chunk:
+                break
+            digest.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return digest.digest()
 
-    # Build a new file name based on the destination folder and file extension
-    file_extension: str = file.suffix[1:] if file.suffix.startswith(".") else file.suffix
-    file_name: str = file.stem
-    new_file_name: AsyncPath = dest / (file_extension or "without_extension") / f"{file_name}.{file_extension}"
 
-    # Verify if a file with the same name already exists
-    rename_tries: int = 0
-    while await new_file_name.exists():
-        rename_tries += 1
-        # Build a new file name with index of copy
-        new_file_name = new_file_name.with_stem(f"{file_name} ({rename_tries})")
+class ContentEntry:
+    """
+    Distinct file content found by the deduplication: the first source file with this content.
+    """
+    __slots__ = ("source", "mtime_ns", "partial", "full", "destination")
 
-    return new_file_name
+    def __init__(self, source: str, mtime_ns: int = 0) -> None:
+        """
+        :param source: Source file
+        :param mtime_ns: Modification time of the source file, nanoseconds
+        """
+        self.source: str = source
+        self.mtime_ns: int = mtime_ns
+        self.partial: Optional[bytes] = None
+        self.full: Optional[bytes] = None
+        # Destination of the copied content (None if the copying failed), resolved by the copying worker
+        self.destination: asyncio.Future = asyncio.get_running_loop().create_future()
 
+    async def digest(self, full: bool) -> bytes:
+        """
+        Return the partial or full content digest, hashing the source file on the first call.
 
-async def read_folder(source_folder: AsyncPath) -> list[AsyncPath]:
+        :param full: Full content digest, otherwise the digest of the leading PARTIAL_HASH_SIZE bytes
+        :return: Content digest
+        """
+        if full:
+            if self.full is None:
+                self.full = await run_io(hash_file, self.source, None)
+            return self.full
+        if self.partial is None:
+            self.partial = await run_io(hash_file, self.source, PARTIAL_HASH_SIZE)
+        return self.partial
+
+
+class DedupeIndex:
     """
-    Asynchronously and recursively iterates through all files in a folder and its subfolders,
-    returning a list of the files found.
+    Index of the distinct file contents.
 
-    :param source_folder: Folder for iterate
-    :return: List of files
+    The files are compared in tiers: by size (free), then by the digest of the leading bytes,
+    then by the full digest. A tier is hashed only when two files collide in the previous one,
+    so a file with a unique size is never read twice.
+    """
+
+    def __init__(self, link: bool = False) -> None:
+        """
+        :param link: Hard link the duplicates to the copied content, otherwise skip them
+        """
+        self.link: bool = link
+        # The fingerprinting of the same-size files is serialized
+        self._locks: KeyedLock = KeyedLock()
+        # First file per size (None once it has been moved to the partial digest tier)
+        self._sizes: dict[int, Optional[ContentEntry]] = {}
+        # First file per size and partial digest (None once it has been moved to the full digest tier)
+        self._partials: dict[tuple[int, bytes], Optional[ContentEntry]] = {}
+        # File per size and full digest
+        self._fulls: dict[tuple[int, bytes], ContentEntry] = {}
+
+    async def claim(self, file: SourceFile) -> tuple[ContentEntry, bool]:
+        """
+        Find the content of the file in the index, adding it if it is new.
+
+        :param file: Source file
+        :return: Content entry and the flag of a duplicate: if the file is new, the caller must copy
+                 it and resolve the entry destination, otherwise the entry is the original content
+        """
+        entry: ContentEntry = ContentEntry(os.fspath(file.path), file.mtime_ns)
+        async with self._locks.hold(file.size):
+            # Size tier
+            if file.size not in self._sizes:
+                self._sizes[file.size] = entry
+                return entry, False
+            if (first := self._sizes[file.size]) is not None:
+                self._partials[(file.size, await first.digest(full=False))] = first
+                self._sizes[file.size] = None
+
+            # Partial digest tier
+            partial_key: tuple[int, bytes] = (file.size, await entry.digest(full=False))
+            if partial_key not in self._partials:
+                self._partials[partial_key] = entry
+                return entry, False
+            if file.size <= PARTIAL_HASH_SIZE:
+                # The partial digest covers the whole content
+                return self._partials[partial_key], True
+            if (first := self._partials[partial_key]) is not None:
+                self._fulls[(file.size, await first.digest(full=True))] = first
+                self._partials[partial_key] = None
+
+            # Full digest tier
+            full_key: tuple[int, bytes] = (file.size, await entry.digest(full=True))
+            if full_key not in self._fulls:
+                self._fulls[full_key] = entry
+                return entry, False
+            return self._fulls[full_key], True
+
+
+class InodeIndex:
+    """
+    Index of the source files with several hard links: the first link found is copied,
+    the other links are hard linked to the copy, so every inode is read once.
+    """
+
+    def __init__(self) -> None:
+        self._inodes: dict[tuple[int, int], ContentEntry] = {}
+
+    def claim(self, file: SourceFile) -> tuple[ContentEntry, bool]:
+        """
+        Find the inode of the file in the index, adding it if it is new.
+
+        :param file: Source file with several hard links
+        :return: Content entry and the flag of a duplicate: if the inode is new, the caller must copy
+                 the file and resolve the entry destination, otherwise the entry is the first link
+        """
+        if (entry := self._inodes.get(file.inode)) is not None:
+            return entry, True
+        entry = self._inodes[file.inode] = ContentEntry(os.fspath(file.path), file.mtime_ns)
+        return entry, False
+
+
+class CopyContext:
     """
-    logging.info(f"Process folder: {source_folder.as_posix()}")
+    Settings and shared state of a folder copy run.
+    """
+
+    def __init__(
+            self,
+            max_inflight_bytes: Optional[int] = None,
+            copy_mode: str = "auto",
+            link_mode: str = "copy",
+            manifest: Optional[str] = None,
+            dedupe: bool = False,
+            dedupe_link: bool = False,
+            small_file_size: int = DEFAULT_SMALL_FILE_SIZE,
+            large_file_size: int = DEFAULT_LARGE_FILE_SIZE,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            routes: Optional[str] = None,
+            hardlinks: bool = False,
+    ) -> None:
+        """
+        :param max_inflight_bytes: Maximum total size of the files being copied at the same time (None - unlimited)
+        :param copy_mode: Copy mode, one of COPY_MODES
+        :param link_mode: Link mode, one of LINK_MODES
+        :param manifest: Copy manifest file of the incremental mode (None - copy everything)
+        :param dedupe: Copy every distinct file content once
+        :param dedupe_link: Hard link the duplicates to the copied content (implies dedupe)
+        :param small_file_size: Files up to this size are copied in batches (0 - no batching)
+        :param large_file_size: Files from this size are copied in parallel chunks (0 - no chunking)
+        :param chunk_size: Size of a chunk of a large file
+        :param routes: Routing rules file of the destination folders (None - a folder per extension)
+        :param hardlinks: Copy every source inode once, hard linking its other links to the copy
+        """
+        if chunk_size < 1:
+            raise ValueError('The chunk size must be positive')
+        if copy_mode not in COPY_MODES:
+            raise ValueError(f'Unknown copy mode: "{copy_mode}"')
+        if link_mode not in LINK_MODES:
+            raise ValueError(f'Unknown link mode: "{link_mode}"')
+        if link_mode == "move" and (dedupe or dedupe_link or hardlinks):
+            # The skipped or linked duplicates would stay in the source folder
+            raise ValueError('The move mode cannot be combined with the deduplication or the hard links mode')
+
+        self.copy_mode: str = copy_mode
+        self.link_mode: str = link_mode
+        self.budget: ByteBudget = ByteBudget(max_inflight_bytes)
+        self.stats: CopyStats = CopyStats()
+        self.registry: NameRegistry = NameRegistry(self.stats)
+        self.folders: FolderCache = FolderCache()
+        # Claims of the destination names are serialized per file name (intra-process only),
+        # the exclusive file creation protects the names from the other processes
+        self.filename_locks: KeyedLock = KeyedLock()
+        self.manifest: Optional[CopyManifest] = None
+        if manifest is not None:
+            os.makedirs(os.path.dirname(manifest), exist_ok=True)
+            self.manifest = CopyManifest(manifest)
+        self.dedupe: Optional[DedupeIndex] = DedupeIndex(dedupe_link) if dedupe or dedupe_link else None
+        # The fingerprinting of the deduplication mode works per file, the small files are not batched there
+        self.small_file_size: int = small_file_size if self.dedupe is None else 0
+        self.large_file_size: int = large_file_size
+        self.chunk_size: int = chunk_size
+        self.router: Optional[RoutingRules] = load_routes(routes) if routes is not None else None
+        self.inodes: Optional[InodeIndex] = InodeIndex() if hardlinks else None
+
+    def is_small(self, file: SourceFile) -> bool:
+        """
+        :return: The file is copied in a batch with the other small files
+        """
+        # The hard links are tracked per file
+        return file.size <= self.small_file_size and (self.inodes is None or file.inode is None)
+
+    def is_large(self, size: int) -> bool:
+        """
+        :return: The file of this size is copied in parallel chunks
+        """
+        return (
+            0 < self.large_file_size <= size
+            and self.link_mode == "copy"
+            and self.copy_mode in ("auto", "copy_file_range", "buffered")
+        )
+
+    def close(self) -> None:
+        """
+        Release the resources of the copy run.
+        """
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+
+
+async def claim_destination(
+        file: AsyncPath,
+        folder: AsyncPath,
+        context: CopyContext,
+        size: int = 0,
+        mtime_ns: int = 0,
+        planned: Optional[AsyncPath] = None,
+) -> AsyncPath:
+    """
+    Choose a free destination name for the file and claim it with an exclusive file creation.
+
+    :param file: Source file
+    :param folder: Destination folder
+    :param context: Settings and shared state of the copy run
+    :param size: Source file size (for the routing templates)
+    :param mtime_ns: Source file modification time, nanoseconds (for the routing templates)
+    :param planned: Destination chosen in advance (copy plan, optional), if it is taken
+                    the next free name in its folder is claimed instead
+    :return: Claimed destination file (empty)
+    """
+    # Folder of a taken planned destination
+    planned_folder: Optional[AsyncPath] = None
+    while True:
+        # Build a new file name based on the destination folder and file extension
+        with context.stats.timed("naming"):
+            if planned is not None:
+                new_file: AsyncPath = planned
+            elif planned_folder is not None:
+                new_file = await context.registry.claim(
+                    planned_folder, file.stem, file.suffix[1:] if file.suffix.startswith(".") else file.suffix
+                )
+            else:
+                new_file = await file_path_build(file, folder, context.registry, context.router, size, mtime_ns)
+        # Create a new folder if it has not been created yet (once per folder)
+        with context.stats.timed("mkdir"):
+            await context.folders.ensure(new_file.parent)
+        try:
+            with context.stats.timed("naming"):
+                await run_io(reserve_file, os.fspath(new_file))
+            return new_file
+        except FileExistsError:
+            if planned is not None:
+                # Stale plan or another run into the same folder - the existing file is kept
+                logging.warning(f"Planned destination is taken, the file gets a new name: {planned.as_posix()}")
+                planned_folder, planned = planned.parent, None
+                continue
+            # The name was taken by another process after the folder had been listed - take the next one
+            logging.debug("Destination name is taken: %s", new_file)
+            context.stats.claim_retries += 1
+        except FileNotFoundError:
+            # The folder was removed during the run - create it again on the next try
+            context.folders.forget(new_file.parent)
+
+
+async def copy_file(
+        file: AsyncPath,
+        folder: AsyncPath,
+        context: CopyContext,
+        destination: Optional[AsyncPath] = None,
+        size: Optional[int] = None,
+        mtime_ns: int = 0,
+        planned: Optional[AsyncPath] = None,
+) -> Optional[AsyncPath]:
+    """
+    Asynchronous copying of a file to a folder based on its extension.
+
+    Only the claim of the destination name is serialized (per file name),
+    the copying of the files with the same name runs concurrently.
+
+    :param file: Source file
+    :param folder: Destination folder
+    :param context: Settings and shared state of the copy run
+    :param destination: Known destination file to overwrite (optional, by default a new name is claimed),
+                        the file is copied under a temporary name and renamed over it, so an existing file
+                        is never truncated in place (its other hard links keep their content)
+    :param size: Source file size (optional, the large files of known size are copied in parallel chunks)
+    :param mtime_ns: Source file modification time, nanoseconds (for the routing templates)
+    :param planned: Destination chosen in advance (copy plan, optional), claimed like a new name
+    :return: Destination file, None if the copying failed
+    """
+    start: float = time.perf_counter()
+    if destination is None:
+        # Locking is based on the file name
+        async with context.filename_locks.hold(file.name.lower()):
+            new_file: AsyncPath = await claim_destination(file, folder, context, size or 0, mtime_ns, planned)
+    else:
+        new_file = destination
+        with context.stats.timed("mkdir"):
+            await context.folders.ensure(new_file.parent)
 
-    files: list[AsyncPath] = []
+    if context.manifest is not None:
+        context.manifest.start(os.fspath(file), os.fspath(new_file))
 
+    # Copy the file over the claimed (empty) destination or next to the known one
+    target: str = os.fspath(new_file) if destination is None else temporary_path(os.fspath(new_file))
     try:
-        async for child in source_folder.iterdir():
-            if await child.is_dir():
-                files.extend(await read_folder(child))
-            elif await child.is_file():
-                files.append(child)
+        with context.stats.timed("copy"):
+            if size is not None and context.is_large(size):
+                method: str = await copy_file_chunked(
+                    os.fspath(file), target, size, context.chunk_size, context.copy_mode
+                )
             else:
-                # symbolic links/devices, etc. — ignore them
-                logging.warn(f"Skip non-regular: {child.as_posix()}")
+                method = await run_io(place_file, os.fspath(file), target, context.link_mode, context.copy_mode)
+            if destination is not None:
+                await run_io(os.replace, target, os.fspath(new_file))
+        # Lazy arguments - the per-file messages are formatted only when DEBUG is enabled
+        logging.debug("File: %s copied to %s (%s)", file, new_file, method)
+        context.stats.copied(size or 0)
+        context.stats.observe_latency(time.perf_counter() - start)
+        return new_file
     except OSError as e:
-        logging.info(f"Failed to process folder \"{source_folder.as_posix()}\": {str(e)}")
-    finally:
-        return files
+        logging.error(f'Failed to copy file "{file.as_posix()}" to "{new_file.as_posix()}": {str(e)}')
+        context.stats.files_failed += 1
+        if destination is None:
+            # Do not leave the empty claimed file behind
+            await run_io(remove_file, os.fspath(new_file))
+        elif await run_io(os.path.lexists, os.fspath(file)):
+            # The temporary copy is removed, unless it is the only one left of a moved file
+            await run_io(remove_file, target)
+        return None
 
 
-async def copy_file(file: AsyncPath, folder: AsyncPath, filename_locks: dict[str, asyncio.Lock]) -> None:
+async def place_duplicate(
+        file: AsyncPath,
+        folder: AsyncPath,
+        context: CopyContext,
+        original: str,
+        size: int = 0,
+        mtime_ns: int = 0,
+        link: bool = True,
+        destination: Optional[AsyncPath] = None,
+) -> Optional[AsyncPath]:
     """
-    Asynchronous copying of a file to a folder based on its extension.
+    Handle a file whose content has already been copied: hard link it to the copy or skip it.
 
     :param file: Source file
     :param folder: Destination folder
-    :param filename_locks: Locking collection based on the file name
+    :param context: Settings and shared state of the copy run
+    :param original: Destination of the copied content
+    :param size: Source file size (for the routing templates)
+    :param mtime_ns: Source file modification time, nanoseconds (for the routing templates)
+    :param link: Hard link the file to the copy, otherwise skip it
+    :param destination: Previous own copy of the file to replace (optional, by default a new name is claimed)
+    :return: Destination representing the file, None if the linking failed
     """
-    # Locking is based on the file name
-    lock = filename_locks[file.name.lower()]
-    async with lock:
-        # Build a new file name based on the destination folder and file extension
-        new_file = await file_path_build(file, folder)
+    if not link:
+        if destination is not None:
+            # The file is represented by the copy of the same content now
+            await run_io(remove_file, os.fspath(destination))
+        logging.debug("File: %s is a duplicate of %s", file, original)
+        return AsyncPath(original)
+
+    if destination is None:
+        # Locking is based on the file name
+        async with context.filename_locks.hold(file.name.lower()):
+            new_file: AsyncPath = await claim_destination(file, folder, context, size, mtime_ns)
+    else:
+        # The link is renamed over the previous copy
+        new_file = destination
+        with context.stats.timed("mkdir"):
+            await context.folders.ensure(new_file.parent)
+    try:
+        with context.stats.timed("copy"):
+            await run_io(place_file, original, os.fspath(new_file), "hardlink")
+        logging.debug("File: %s linked to %s (duplicate of %s)", file, new_file, original)
+        return new_file
+    except OSError as e:
+        logging.error(f'Failed to link file "{file.as_posix()}" to "{new_file.as_posix()}": {str(e)}')
+        if destination is None:
+            await run_io(remove_file, os.fspath(new_file))
+        return None
+
+
+async def place_known_content(
+        file: SourceFile,
+        folder: AsyncPath,
+        context: CopyContext,
+        content: ContentEntry,
+        link: bool,
+        destination: Optional[AsyncPath] = None,
+) -> bool:
+    """
+    Handle a file whose content is copied by another file: wait for that copy, then link the file to it or skip it.
+
+    :param file: Source file
+    :param folder: Destination folder
+    :param context: Settings and shared state of the copy run
+    :param content: Entry of the content copied by the other file
+    :param link: Hard link the file to the copy, otherwise skip it
+    :param destination: Previous own copy of the file to replace (optional)
+    :return: True if the file is handled, False if the other copy failed and the file must be copied itself
+    """
+    original: Optional[str] = await asyncio.shield(content.destination)
+    if original is None:
+        return False
+    new_file: Optional[AsyncPath] = await place_duplicate(
+        file.path, folder, context, original, file.size, file.mtime_ns, link, destination
+    )
+    if new_file is None:
+        context.stats.files_failed += 1
+        return True
+    context.stats.skipped(file.size)
+    if context.manifest is not None:
+        if link:
+            context.manifest.start(os.fspath(file.path), os.fspath(new_file))
+        else:
+            # The copy belongs to the original file, the duplicate must not overwrite it when it changes
+            context.manifest.start(os.fspath(file.path), os.fspath(new_file), content.source, content.mtime_ns)
+        context.manifest.finish(os.fspath(file.path), file.size, file.mtime_ns)
+    return True
+
+
+def original_unchanged(record: ManifestRecord) -> bool:
+    """
+    Check that the original file of a skipped duplicate has not changed since the duplicate was found
+    (blocking, runs in the executor).
+
+    :param record: Manifest record of the skipped duplicate
+    :return: True if the original source file still has the size and the modification time of the duplicate
+    """
+    try:
+        stat: os.stat_result = os.stat(record.original)
+    except OSError:
+        return False
+    return stat.st_size == record.size and stat.st_mtime_ns == record.original_mtime_ns
+
+
+async def previous_copy(
+        file: Union[SourceFile, PlannedFile],
+        context: CopyContext,
+) -> tuple[bool, Optional[AsyncPath]]:
+    """
+    Look up the previous copy of the file in the manifest of the incremental mode.
+    An up to date file is counted as skipped.
+
+    :param file: Source file
+    :param context: Settings and shared state of the copy run
+    :return: The flag of an up to date copy and the destination of a changed or interrupted own copy to overwrite
+    """
+    if context.manifest is None or (record := context.manifest.lookup(os.fspath(file.path))) is None:
+        return False, None
+    up_to_date: bool = record.done and record.size == file.size and record.mtime_ns == file.mtime_ns
+    if up_to_date and record.original is not None:
+        # Skipped duplicate - its content is in the copy of the original file, unless that file has changed
+        up_to_date = await run_io(original_unchanged, record)
+    if up_to_date:
+        logging.debug("File: %s is up to date in %s", file.path, record.destination)
+        context.stats.skipped(file.size)
+        return True, None
+    # The copy of the original file of a skipped duplicate is never overwritten
+    return False, AsyncPath(record.destination) if record.original is None else None
+
+
+def moved_already(file: Union[SourceFile, PlannedFile], folder: AsyncPath, context: CopyContext) -> bool:
+    """
+    Check if the file of the move mode is in its destination folder already, e.g. sorted by an earlier run
+    into the source folder itself. Such a file is left in place and counted as skipped.
+
+    :param file: Source file
+    :param folder: Destination folder
+    :param context: Settings and shared state of the copy run
+    :return: True if the file is not moved
+    """
+    if context.link_mode != "move" or isinstance(file, PlannedFile):
+        return False
+    try:
+        if destination_folder(file.path, folder, context.router, file.size, file.mtime_ns) != file.path.parent:
+            return False
+    except ValueError:
+        # Not routable - reported by the move itself
+        return False
+    logging.debug("File: %s is in its destination folder already", file.path)
+    context.stats.skipped(file.size)
+    return True
+
+
+async def process_file(file: Union[SourceFile, PlannedFile], folder: AsyncPath, context: CopyContext) -> None:
+    """
+    Copy a discovered or planned file, taking into account the copy manifest of the incremental mode,
+    the already copied contents of the deduplication mode and the already copied inodes of the hard links mode.
+
+    :param file: Source file
+    :param folder: Destination folder
+    :param context: Settings and shared state of the copy run
+    """
+    source: str = os.fspath(file.path)
+    planned: Optional[AsyncPath] = file.destination if isinstance(file, PlannedFile) else None
+    if moved_already(file, folder, context):
+        return
+    up_to_date, previous = await previous_copy(file, context)
+    if up_to_date:
+        return
+    # Changed or interrupted copy - overwrite the previous destination instead of creating a new name;
+    # a planned destination is claimed, unless it is the own previous copy
+    destination: Optional[AsyncPath] = previous if planned is None or previous == planned else None
+
+    # Entries of the content copied by this file, the duplicates wait for them
+    contents: list[ContentEntry] = []
+    if context.inodes is not None and destination is None and isinstance(file, SourceFile) and file.inode is not None:
+        content, duplicate = context.inodes.claim(file)
+        if not duplicate:
+            contents.append(content)
+        elif await place_known_content(file, folder, context, content, link=True):
+            context.stats.files_linked += 1
+            return
+
+    new_file: Optional[AsyncPath] = None
+    try:
+        if context.dedupe is not None and planned is None:
+            # A changed file goes through the deduplication again, its previous copy is replaced
+            try:
+                content, duplicate = await context.dedupe.claim(file)
+            except OSError as e:
+                logging.error(f'Failed to fingerprint file "{file.path.as_posix()}": {str(e)}')
+                content, duplicate = None, False
+            if not duplicate:
+                if content is not None:
+                    contents.append(content)
+            elif await place_known_content(file, folder, context, content, context.dedupe.link, destination):
+                # Not copied - the other hard links of this file go through the deduplication themselves
+                return
+
+        new_file = await copy_file(file.path, folder, context, destination, file.size, file.mtime_ns, planned)
+    finally:
+        for content in contents:
+            # Release the duplicates waiting for this content (None - they copy themselves)
+            content.destination.set_result(os.fspath(new_file) if new_file is not None else None)
+
+    if new_file is not None and context.manifest is not None:
+        context.manifest.finish(source, file.size, file.mtime_ns)
+
+
+async def process_small_files(files: list[SourceFile], folder: AsyncPath, context: CopyContext) -> None:
+    """
+    Copy a batch of small files with a single executor job, amortizing the thread hops.
+
+    :param files: Source files
+    :param folder: Destination folder
+    :param context: Settings and shared state of the copy run
+    """
+    start: float = time.perf_counter()
+    jobs: list[tuple[str, str, bool]] = []
+    batch: list[SourceFile] = []
+    for file in files:
+        source: str = os.fspath(file.path)
+        if moved_already(file, folder, context):
+            continue
+        up_to_date, destination = await previous_copy(file, context)
+        if up_to_date:
+            continue
+        # Changed or interrupted copy - overwrite the previous destination, otherwise claim a new name
+        claim: bool = destination is None
+        if claim:
+            # The name is reserved in the registry now and claimed on disk by the batch job,
+            # it is recorded in the manifest only once the claim has succeeded
+            try:
+                with context.stats.timed("naming"):
+                    destination = await file_path_build(
+                        file.path, folder, context.registry, context.router, file.size, file.mtime_ns
+                    )
+            except ValueError as e:
+                logging.error(f'Failed to route file "{file.path.as_posix()}": {str(e)}')
+                context.stats.files_failed += 1
+                continue
+        with context.stats.timed("mkdir"):
+            await context.folders.ensure(destination.parent)
+        jobs.append((source, os.fspath(destination), claim))
+        batch.append(file)
+
+    if not jobs:
+        return
+
+    with context.stats.timed("copy"):
+        results: list = await run_io(place_files, jobs, context.link_mode, context.copy_mode)
+    # The files of the batch are copied together - every one gets its share of the batch time
+    latency: float = (time.perf_counter() - start) / len(jobs)
+    for file, (source, destination, claim), result in zip(batch, jobs, results):
+        if isinstance(result, FileExistsError) and claim:
+            # The name was taken by another process - copy the file alone, with the next free name
+            await process_file(file, folder, context)
+        elif isinstance(result, OSError):
+            logging.error(f'Failed to copy file "{file.path.as_posix()}" to "{AsyncPath(destination).as_posix()}": '
+                          f'{str(result)}')
+            context.stats.files_failed += 1
+            if claim:
+                await run_io(remove_file, destination)
+        else:
+            logging.debug("File: %s copied to %s (%s)", file.path, destination, result)
+            context.stats.copied(file.size)
+            context.stats.observe_latency(latency)
+            if context.manifest is not None:
+                context.manifest.start(source, destination)
+                context.manifest.finish(source, file.size, file.mtime_ns)
+
+
+async def copy_worker(queue: asyncio.Queue, folder: AsyncPath, context: CopyContext) -> None:
+    """
+    Copy worker: drains the queue of discovered or planned files (or batches of small files)
+    until it receives the stop marker (None).
+
+    :param queue: Queue of the files to copy
+    :param folder: Destination folder
+    :param context: Settings and shared state of the copy run
+    """
+    while True:
+        item: Union[SourceFile, PlannedFile, list[SourceFile], None] = await queue.get()
         try:
-            # Create a new folder if it does not already exist
-            await new_file.parent.mkdir(parents=True, exist_ok=True)
-            # Copy the file
-            await copyfile(file, new_file)
-            logging.info(f"File: {file.as_posix()} copied to {new_file.as_posix()}")
-        except OSError as e:
-            logging.error(f'Failed to copy file "{file.as_posix()}" to "{new_file.as_posix()}": {str(e)}')
+            if item is None:
+                # Stop marker - the folder walk is finished
+                return
+            if isinstance(item, list):
+                async with context.budget.reserve(sum(file.size for file in item)):
+                    context.stats.in_flight += len(item)
+                    try:
+                        await process_small_files(item, folder, context)
+                    finally:
+                        context.stats.in_flight -= len(item)
+            else:
+                async with context.budget.reserve(item.size):
+                    context.stats.in_flight += 1
+                    try:
+                        await process_file(item, folder, context)
+                    finally:
+                        context.stats.in_flight -= 1
+        except Exception as e:
+            # One broken file must not stop the worker, otherwise the queue would never be drained
+            failed: str = item.path.as_posix() if not isinstance(item, list) else f"{len(item)} small files"
+            logging.error(f'Failed to copy "{failed}": {str(e)}')
+        finally:
+            queue.task_done()
+
+
+async def copy_files(
+        files: AsyncIterator[Union[SourceFile, PlannedFile]],
+        dest_folder: AsyncPath,
+        context: CopyContext,
+        workers: int = DEFAULT_WORKERS,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+) -> None:
+    """
+    Copy the files with a pool of copy workers, fed through a bounded queue.
+
+    The small files are grouped into batches; a batch is sent when it is full
+    or when the workers are idle (the queue is empty).
+
+    :param files: Asynchronous iterator of the files to copy
+    :param dest_folder: Destination folder
+    :param context: Settings and shared state of the copy run
+    :param workers: Number of concurrent copy workers
+    :param queue_size: Maximum number of files waiting for copying
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max(queue_size, 1))
+    context.stats.queue = queue
+    consumers: list[asyncio.Task] = [
+        asyncio.create_task(copy_worker(queue, dest_folder, context)) for _ in range(workers)
+    ]
+    small_files: list[SourceFile] = []
+    try:
+        async for file in files:
+            if isinstance(file, PlannedFile) or not context.is_small(file):
+                await queue.put(file)
+                continue
+            small_files.append(file)
+            if len(small_files) >= SMALL_FILES_BATCH or queue.empty():
+                await queue.put(small_files)
+                small_files = []
+        if small_files:
+            await queue.put(small_files)
+    finally:
+        # Stop the workers after the queue has been drained
+        for _ in consumers:
+            await queue.put(None)
+        await asyncio.gather(*consumers)
+
+
+def shard_of(
+        file: Union[SourceFile, PlannedFile],
+        shards: int,
+        by_size: bool = False,
+        by_inode: bool = False,
+) -> int:
+    """
+    Choose the worker process of the file.
+
+    The files are sharded by the file name, so all the files which compete for the same
+    destination names are handled by the same process and its name registry.
+    In the deduplication mode the files are sharded by size, so the possible duplicates
+    meet in the same process; in the hard links mode the files with several links are sharded by inode.
+
+    :param file: Source file
+    :param shards: Number of worker processes
+    :param by_size: Shard by the file size instead of the file name
+    :param by_inode: Shard the files with several hard links by inode instead of the file name
+    :return: Index of the worker process
+    """
+    if by_size:
+        return file.size % shards
+    if by_inode and isinstance(file, SourceFile) and file.inode is not None:
+        return file.inode[1] % shards
+    return zlib.crc32(file.path.name.lower().encode("utf-8", "surrogateescape")) % shards
+
+
+async def receive_files(
+        files_queue: multiprocessing.Queue,
+        stats: Optional[CopyStats] = None,
+) -> AsyncIterator[Union[SourceFile, PlannedFile]]:
+    """
+    Receive the batches of files sent by the parent process, until the stop marker (None).
+
+    :param files_queue: Inter-process queue of the file batches
+    :param stats: Counters of the worker process (optional)
+    :return: Asynchronous iterator of files
+    """
+    if stats is None:
+        stats = CopyStats()
+    loop = asyncio.get_running_loop()
+    while (batch := await loop.run_in_executor(None, files_queue.get)) is not None:
+        for file in batch:
+            stats.found(file.size)
+            yield file
+    stats.walk_done = True
+
+
+def copy_shard(
+        files_queue: multiprocessing.Queue,
+        dest: str,
+        workers: int,
+        queue_size: int,
+        settings: dict,
+        io_backend_name: str = "default",
+        io_threads: Optional[int] = None,
+        progress_interval: float = 0,
+        results_queue: Optional[multiprocessing.Queue] = None,
+        metrics_interval: float = 0,
+        log_level: int = logging.INFO,
+) -> None:
+    """
+    Entry point of a worker process: copies the files received from the parent process
+    with its own event loop and copy workers.
+
+    :param files_queue: Inter-process queue of the file batches
+    :param dest: Destination folder (absolute)
+    :param workers: Number of concurrent copy workers
+    :param queue_size: Maximum number of files waiting for copying
+    :param settings: Arguments of the CopyContext
+    :param io_backend_name: I/O backend, one of IO_BACKENDS
+    :param io_threads: Number of the I/O threads
+    :param progress_interval: Interval of the progress reports, seconds (0 - no reports)
+    :param results_queue: Inter-process queue for the counters of the worker process (optional)
+    :param metrics_interval: Interval of the counter updates sent for the metrics, seconds (0 - only the final ones)
+    :param log_level: Logging level
+    """
+    # The log listener thread of the parent process is not inherited (and spawned processes inherit nothing)
+    listener: logging.handlers.QueueListener = setup_logging(log_level)
+
+    name: str = multiprocessing.current_process().name
+
+    def counters(stats: CopyStats) -> dict:
+        # The files are counted as found by the parent process
+        return {
+            **stats.as_dict(), "files_found": 0, "bytes_found": 0, "folders": 0,
+            "in_flight": stats.in_flight, "queued": stats.queue.qsize() if stats.queue is not None else 0,
+        }
+
+    async def publish(stats: CopyStats) -> None:
+        while True:
+            await asyncio.sleep(metrics_interval)
+            results_queue.put((name, False, counters(stats)))
+
+    async def run() -> None:
+        context: CopyContext = CopyContext(**settings)
+        reporter: Optional[asyncio.Task] = None
+        if progress_interval > 0:
+            reporter = asyncio.create_task(report_progress(context.stats, progress_interval, name))
+        publisher: Optional[asyncio.Task] = None
+        if metrics_interval > 0 and results_queue is not None:
+            publisher = asyncio.create_task(publish(context.stats))
+        try:
+            with use_io_backend(io_backend_name, io_threads):
+                await copy_files(
+                    receive_files(files_queue, context.stats), AsyncPath(dest), context, workers, queue_size
+                )
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            if publisher is not None:
+                publisher.cancel()
+            context.close()
+            if results_queue is not None:
+                results_queue.put((name, True, counters(context.stats)))
+
+    try:
+        asyncio.run(run())
+    finally:
+        listener.stop()
+
+
+def send_batch(files_queue: multiprocessing.Queue, process: multiprocessing.Process, batch: Optional[list]) -> None:
+    """
+    Send a batch of files to a worker process (blocking, runs in the executor).
+
+    :param files_queue: Inter-process queue of the file batches
+    :param process: Worker process
+    :param batch: Batch of files or the stop marker (None)
+    """
+    while True:
+        try:
+            files_queue.put(batch, timeout=1)
+            return
+        except queue_module.Full:
+            if not process.is_alive():
+                raise RuntimeError(f"Worker process {process.name} exited with code {process.exitcode}")
+
 
+def receive_results(results_queue: multiprocessing.Queue) -> list[Optional[tuple[str, bool, dict]]]:
+    """
+    Receive the counters sent by the worker processes (blocking for a second at most, runs in the executor).
+
+    :param results_queue: Inter-process queue of the counters
+    :return: Received messages: process name, final flag and counters, or the stop marker (None)
+    """
+    results: list[Optional[tuple[str, bool, dict]]] = []
+    try:
+        results.append(results_queue.get(timeout=1))
+        while True:
+            results.append(results_queue.get_nowait())
+    except queue_module.Empty:
+        pass
+    return results
+
+
+async def sharded_copy(
+        files: AsyncIterator[Union[SourceFile, PlannedFile]],
+        dest_folder: AsyncPath,
+        processes: int,
+        workers: int,
+        queue_size: int,
+        settings: dict,
+        io_backend_name: str = "default",
+        io_threads: Optional[int] = None,
+        progress_interval: float = 0,
+        stats: Optional[CopyStats] = None,
+        metrics_interval: float = 0,
+) -> None:
+    """
+    Discover the files in this process (walk or plan) and copy them in several worker processes.
+
+    :param files: Asynchronous iterator of the files to copy
+    :param dest_folder: Destination folder
+    :param processes: Number of worker processes
+    :param workers: Number of concurrent copy workers per process
+    :param queue_size: Maximum number of files waiting for copying per process
+    :param settings: Arguments of the CopyContext
+    :param io_backend_name: I/O backend of the worker processes, one of IO_BACKENDS
+    :param io_threads: Number of the I/O threads per worker process
+    :param progress_interval: Interval of the progress reports of the worker processes, seconds (0 - no reports)
+    :param stats: Counters of the copy run, the counters of the worker processes are added to them (optional)
+    :param metrics_interval: Interval of the counter updates of the worker processes, seconds (0 - only the final ones)
+    """
+    loop = asyncio.get_running_loop()
+
+    results_queue: multiprocessing.Queue = multiprocessing.Queue()
+    queues: list[multiprocessing.Queue] = [multiprocessing.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in range(processes)]
+    workers_processes: list[multiprocessing.Process] = [
+        multiprocessing.Process(
+            target=copy_shard,
+            args=(
+                files_queue, os.fspath(dest_folder), workers, queue_size, settings, io_backend_name, io_threads,
+                progress_interval, results_queue, metrics_interval, logging.getLogger().level,
+            ),
+            name=f"folder-copy-{index}",
+        )
+        for index, files_queue in enumerate(queues)
+    ]
+    for process in workers_processes:
+        process.start()
+
+    async def collect_results() -> None:
+        while True:
+            for result in await loop.run_in_executor(None, receive_results, results_queue):
+                if result is None:
+                    return
+                name, final, counters = result
+                if stats is None:
+                    continue
+                if final:
+                    stats.parts.pop(name, None)
+                    stats.merge(counters)
+                else:
+                    stats.parts[name] = counters
+
+    collector: asyncio.Task = asyncio.create_task(collect_results())
+
+    batches: list[list[Union[SourceFile, PlannedFile]]] = [[] for _ in range(processes)]
+    try:
+        async for file in files:
+            shard: int = shard_of(
+                file, processes, by_size=settings["dedupe"] or settings["dedupe_link"], by_inode=settings["hardlinks"]
+            )
+            batches[shard].append(file)
+            if len(batches[shard]) >= SHARD_BATCH_SIZE:
+                await loop.run_in_executor(None, send_batch, queues[shard], workers_processes[shard], batches[shard])
+                batches[shard] = []
+    finally:
+        for shard, process in enumerate(workers_processes):
+            try:
+                if batches[shard]:
+                    await loop.run_in_executor(None, send_batch, queues[shard], process, batches[shard])
+                await loop.run_in_executor(None, send_batch, queues[shard], process, None)
+            except RuntimeError as e:
+                logging.error(str(e))
+        for process in workers_processes:
+            await loop.run_in_executor(None, process.join)
+            if process.exitcode:
+                logging.error(f"Worker process {process.name} exited with code {process.exitcode}")
+        # The worker processes are finished - their counters precede the stop marker in the queue
+        results_queue.put(None)
+        await collector
+
+
+class PlanSummary:
+    """
+    Totals of the copy plan for a destination folder.
+    """
+    __slots__ = ("files", "bytes", "collisions")
+
+    def __init__(self) -> None:
+        self.files: int = 0
+        self.bytes: int = 0
+        self.collisions: int = 0
+
+
+async def plan_copy(
+        source_folder: AsyncPath,
+        dest_folder: AsyncPath,
+        output: TextIO,
+        walkers: int = DEFAULT_WALKERS,
+        router: Optional[RoutingRules] = None,
+        walk_filter: Optional[WalkFilter] = None,
+        follow_symlinks: bool = False,
+) -> dict[str, PlanSummary]:
+    """
+    Build the copy plan without touching the data: walk the source folder and choose
+    the destination names in memory (the destination folders are only listed).
+
+    The plan is written as JSON lines: {"source": ..., "destination": ..., "size": ..., "mtime_ns": ...}.
+
+    :param source_folder: Source folder
+    :param dest_folder: Destination folder
+    :param output: Text stream for the plan
+    :param walkers: Number of source folders scanned concurrently
+    :param router: Routing rules of the destination folders (optional, by default a folder per extension)
+    :param walk_filter: Filters of the walk (optional)
+    :param follow_symlinks: Follow the symbolic links to files and folders, otherwise skip them
+    :return: Plan totals per destination folder (relative to the destination root)
+    """
+    registry: NameRegistry = NameRegistry()
+    summary: dict[str, PlanSummary] = {}
+
+    async for file in iter_folder(
+            source_folder, walkers=walkers, walk_filter=walk_filter, follow_symlinks=follow_symlinks
+    ):
+        collisions: int = registry.collisions
+        try:
+            new_file: AsyncPath = await file_path_build(
+                file.path, dest_folder, registry, router, file.size, file.mtime_ns
+            )
+        except ValueError as e:
+            logging.error(f'Failed to route file "{file.path.as_posix()}": {str(e)}')
+            continue
+        output.write(json.dumps({
+            "source": os.fspath(file.path),
+            "destination": os.fspath(new_file),
+            "size": file.size,
+            "mtime_ns": file.mtime_ns,
+        }) + "\n")
+
+        folder: str = os.path.relpath(new_file.parent, dest_folder)
+        if (totals := summary.get(folder)) is None:
+            totals = summary[folder] = PlanSummary()
+        totals.files += 1
+        totals.bytes += file.size
+        totals.collisions += registry.collisions - collisions
+
+    return summary
+
+
+def read_plan_lines(stream: TextIO, count: int) -> list[str]:
+    """
+    Read the next lines of the copy plan (blocking, runs in the executor).
+
+    :param stream: Copy plan stream
+    :param count: Maximum number of lines
+    :return: Lines (empty at the end of the plan)
+    """
+    return list(itertools.islice(stream, count))
+
+
+async def read_plan(
+        plan: str,
+        shard: int = 0,
+        shards: int = 1,
+        batch_size: int = DEFAULT_SCAN_BATCH_SIZE,
+        stats: Optional[CopyStats] = None,
+) -> AsyncIterator[PlannedFile]:
+    """
+    Read the copy plan written by the dry run.
+
+    :param plan: Copy plan file (JSON lines)
+    :param shard: Index of the plan part to read (the plan lines are split between the parts round-robin)
+    :param shards: Number of the plan parts, e.g. the number of the machines executing the plan
+    :param batch_size: Number of the lines read by one executor call
+    :param stats: Counters of the copy run (optional)
+    :return: Asynchronous iterator of the planned files
+    """
+    if not 0 <= shard < shards:
+        raise ValueError(f'Invalid plan part: {shard}/{shards}')
+    if stats is None:
+        stats = CopyStats()
 
-async def folder_copy(source: str, dest: str) -> None:
+    index: int = 0
+    with open(plan, "r", encoding="utf-8") as stream:
+        while lines := await run_io(read_plan_lines, stream, batch_size):
+            for line in lines:
+                index += 1
+                if not line.strip() or (index - 1) % shards != shard:
+                    continue
+                try:
+                    entry: dict = json.loads(line)
+                    file: PlannedFile = PlannedFile(
+                        AsyncPath(entry["source"]),
+                        int(entry.get("size", 0)),
+                        int(entry.get("mtime_ns", 0)),
+                        AsyncPath(entry["destination"]),
+                    )
+                except (ValueError, KeyError, TypeError) as e:
+                    logging.error(f"Invalid copy plan line {index}: {str(e)}")
+                    continue
+                stats.found(file.size)
+                yield file
+    stats.walk_done = True
+
+
+def log_plan_summary(summary: dict[str, PlanSummary]) -> None:
+    """
+    Log the copy plan totals per destination folder, the largest folders first.
+
+    :param summary: Plan totals per destination folder
+    """
+    for folder, totals in sorted(summary.items(), key=lambda item: item[1].bytes, reverse=True):
+        logging.info(f"Plan: {folder}: {totals.files} files, {totals.bytes} bytes, {totals.collisions} renamed")
+    logging.info(
+        f"Plan: total: {sum(totals.files for totals in summary.values())} files, "
+        f"{sum(totals.bytes for totals in summary.values())} bytes, "
+        f"{sum(totals.collisions for totals in summary.values())} renamed"
+    )
+
+
+async def folder_copy(
+        source: str,
+        dest: str,
+        workers: int = DEFAULT_WORKERS,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        max_inflight_bytes: Optional[int] = None,
+        walkers: int = DEFAULT_WALKERS,
+        copy_mode: str = "auto",
+        link_mode: str = "copy",
+        processes: int = 1,
+        incremental: bool = False,
+        dedupe: bool = False,
+        dedupe_link: bool = False,
+        small_file_size: int = DEFAULT_SMALL_FILE_SIZE,
+        large_file_size: int = DEFAULT_LARGE_FILE_SIZE,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        routes: Optional[str] = None,
+        include: Optional[list[str]] = None,
+        exclude: Optional[list[str]] = None,
+        max_depth: Optional[int] = None,
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        newer_than: Optional[float] = None,
+        follow_symlinks: bool = False,
+        hardlinks: bool = False,
+        io_backend_name: str = "default",
+        io_threads: Optional[int] = None,
+        dry_run: bool = False,
+        plan_output: Optional[str] = None,
+        plan: Optional[str] = None,
+        plan_shard: tuple[int, int] = (0, 1),
+        progress_interval: float = 0,
+        stats_output: Optional[str] = None,
+        metrics_host: str = DEFAULT_METRICS_HOST,
+        metrics_port: Optional[int] = None,
+) -> None:
     """
     Asynchronous sorting of files by extension and copying them from the source folder to the destination folder.
 
+    The folder walk and the copying run concurrently: the walker feeds a bounded queue which
+    is drained by a pool of copy workers, so the memory usage is bounded by the queue size.
+    The number of concurrent copies is limited by the number of workers and, optionally,
+    by the total size of the files being copied at the same time.
+    With several processes, the files are sharded by name between the worker processes,
+    each of them running its own pool of copy workers.
+
     :param source: Source folder
     :param dest: Destination folder
+    :param workers: Number of concurrent copy workers (per process)
+    :param queue_size: Maximum number of discovered files waiting for copying (per process)
+    :param max_inflight_bytes: Maximum total size of the files being copied at the same time (None - unlimited)
+    :param walkers: Number of source folders scanned concurrently
+    :param copy_mode: Copy mode, one of COPY_MODES
+    :param link_mode: Link mode, one of LINK_MODES (links keep the sorted tree without copying the data,
+                      "move" moves the source files into it)
+    :param processes: Number of worker processes (1 - copy in the current process, the only choice when
+                      the destination is the source folder itself)
+    :param incremental: Copy only the new and changed files, tracking the copies in a manifest
+                        in the destination folder (an interrupted run resumes where it stopped)
+    :param dedupe: Copy every distinct file content once, skipping the duplicates
+    :param dedupe_link: Copy every distinct file content once, hard linking the duplicates to the copy
+    :param small_file_size: Files up to this size are copied in batches, one executor job per batch (0 - no batching)
+    :param large_file_size: Files from this size are copied by chunks in parallel (0 - no chunking)
+    :param chunk_size: Size of a chunk of a large file
+    :param routes: Routing rules file (JSON) mapping extensions, globs and regular expressions
+                   to destination folder templates (None - a folder per extension)
+    :param include: Copy only the files matching one of the glob patterns (None - all the files)
+    :param exclude: Skip the files and the folders matching one of the glob patterns (the folders are not scanned)
+    :param max_depth: Maximum depth of the scanned subfolders (0 - the source folder only, None - unlimited)
+    :param min_size: Skip the files smaller than this size
+    :param max_size: Skip the files larger than this size
+    :param newer_than: Skip the files modified before this time, seconds since the epoch
+    :param follow_symlinks: Follow the symbolic links to files and folders, every folder is scanned once
+                            (by default the links are skipped, not allowed in the move mode)
+    :param hardlinks: Copy every source inode once, hard linking its other links to the copy
+    :param io_backend_name: Executor of the file operations, one of IO_BACKENDS
+                            ("default" - the default executor of the event loop, "threads" - a dedicated thread pool)
+    :param io_threads: Number of the I/O threads of the "threads" backend (per process)
+    :param dry_run: Only build the copy plan, without copying (the copy settings are ignored)
+    :param plan_output: File of the copy plan of the dry run (None or "-" - standard output)
+    :param plan: Copy plan file to execute instead of walking the source folder (the names are not built again)
+    :param plan_shard: Part of the copy plan to execute: index and number of the parts
+    :param progress_interval: Interval of the progress reports, seconds (0 - no reports)
+    :param stats_output: JSON file for the counters and the phase timings of the run (optional)
+    :param metrics_host: Listening address of the metrics endpoint
+    :param metrics_port: Port of the HTTP metrics endpoint (Prometheus text format, None - no endpoint)
     """
+    if workers < 1:
+        raise ValueError('The number of workers must be positive')
+    if processes < 1:
+        raise ValueError('The number of processes must be positive')
 
-    # For asynchronous operations, checking exists() -> creation - is not atomic,
-    # and during parallel copies a race condition may occur
-    # Locking is based on the file name (intra-process only)
-    filename_locks: Optional[dict[str, asyncio.Lock]] = defaultdict(asyncio.Lock)
+    if plan is not None:
+        dry_run = False
+    elif not source:
+        raise ValueError('The source folder or the copy plan must be specified')
 
     # Make paths asynchronous
-    source_folder: AsyncPath = await get_absolute_path(source)
+    source_folder: Optional[AsyncPath] = await get_absolute_path(source) if plan is None else None
     dest_folder: AsyncPath = await get_absolute_path(dest)
+    walk_filter: Optional[WalkFilter] = None
+    prune: list[str] = []
+    # The destination is the source folder itself
+    in_place: bool = False
+    if source_folder is not None:
+        # The destination inside the source folder is not walked, so the copied or moved files are not found again
+        relative: str = os.path.relpath(
+            await run_io(os.path.realpath, dest_folder), await run_io(os.path.realpath, source_folder)
+        )
+        if relative == os.curdir:
+            # Only the destination folders of the run are not walked, they are known to the copying process only
+            if processes > 1 and not dry_run:
+                raise ValueError('The destination cannot be the source folder itself with several processes')
+            in_place = True
+            # The same paths as the walk finds
+            dest_folder = source_folder
+            if incremental:
+                prune.extend(
+                    os.fspath(source_folder / f"{MANIFEST_NAME}{suffix}") for suffix in ("", "-wal", "-shm", "-journal")
+                )
+        elif relative != os.pardir and not relative.startswith(os.pardir + os.sep):
+            prune.append(os.path.join(os.fspath(source_folder), relative))
+    if source_folder is not None and (
+            include or exclude or prune or in_place
+            or any(value is not None for value in (max_depth, min_size, max_size, newer_than))
+    ):
+        walk_filter = WalkFilter(
+            os.fspath(source_folder), include, exclude, max_depth, min_size, max_size, newer_than, prune
+        )
+
+    if dry_run:
+        router: Optional[RoutingRules] = load_routes(routes) if routes is not None else None
+        with use_io_backend(io_backend_name, io_threads):
+            if plan_output is None or plan_output == "-":
+                summary: dict[str, PlanSummary] = await plan_copy(
+                    source_folder, dest_folder, sys.stdout, walkers, router, walk_filter, follow_symlinks
+                )
+            else:
+                with open(plan_output, "w", encoding="utf-8") as output:
+                    summary = await plan_copy(
+                        source_folder, dest_folder, output, walkers, router, walk_filter, follow_symlinks
+                    )
+        log_plan_summary(summary)
+        return
+
+    if link_mode == "move" and follow_symlinks:
+        # The links themselves would be moved (the relative ones broken) and the files of the linked folders
+        # would be moved out of the folders outside the source tree
+        raise ValueError('The move mode cannot be combined with following the symbolic links')
+
+    settings: dict = dict(
+        max_inflight_bytes=max_inflight_bytes,
+        copy_mode=copy_mode,
+        link_mode=link_mode,
+        manifest=os.fspath(dest_folder / MANIFEST_NAME) if incremental else None,
+        dedupe=dedupe,
+        dedupe_link=dedupe_link,
+        small_file_size=small_file_size,
+        large_file_size=large_file_size,
+        chunk_size=chunk_size,
+        routes=routes,
+        hardlinks=hardlinks,
+    )
+    # Validate the settings before any work is started
+    context: CopyContext = CopyContext(**settings)
+    if in_place:
+        # The destination folders are skipped by the walk as soon as they are created
+        walk_filter.destinations = context.folders
+    reporter: Optional[asyncio.Task] = None
+    metrics_server: Optional[asyncio.AbstractServer] = None
+    try:
+        if metrics_port is not None:
+            metrics_server = await serve_metrics(context.stats, metrics_host, metrics_port)
+        with use_io_backend(io_backend_name, io_threads):
+            files: AsyncIterator[Union[SourceFile, PlannedFile]] = (
+                read_plan(plan, *plan_shard, stats=context.stats) if plan is not None
+                else iter_folder(
+                    source_folder, walkers=walkers, stats=context.stats, walk_filter=walk_filter,
+                    follow_symlinks=follow_symlinks,
+                )
+            )
+            if processes > 1:
+                await sharded_copy(
+                    files, dest_folder, processes, workers, queue_size, settings, io_backend_name, io_threads,
+                    progress_interval, context.stats, METRICS_INTERVAL if metrics_server is not None else 0,
+                )
+            else:
+                if progress_interval > 0:
+                    reporter = asyncio.create_task(report_progress(context.stats, progress_interval))
+                await copy_files(files, dest_folder, context, workers, queue_size)
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        context.close()
+
+    logging.info(context.stats.summary())
+    if stats_output is not None:
+        with open(stats_output, "w", encoding="utf-8") as output:
+            json.dump(context.stats.as_dict(), output, indent=2)
 
-    files: list[AsyncPath] = await read_folder(source_folder)
-    await asyncio.gather(*[copy_file(file, dest_folder, filename_locks) for file in files])
+
+def setup_logging(level: int = logging.INFO) -> logging.handlers.QueueListener:
+    """
+    Configure the console logging.
+
+    The records are only queued by the logging calls and written to the console by a listener thread,
+    so a slow console does not block the event loop.
+
+    :param level: Logging level
+    :return: Started listener (stop it at exit to flush the queued records)
+    """
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    log_queue: queue_module.SimpleQueue = queue_module.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, console_handler)
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(level)
+    listener.start()
+    return listener
 
 
 def cli() -> None:
     """
     CLI for copying a folder, with files sorted by their extensions.
     """
+    listener: logging.handlers.QueueListener = setup_logging()
     try:
-        root_logger = logging.getLogger()
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
-        root_logger.addHandler(console_handler)
-        root_logger.setLevel(logging.INFO)
-
         parser = argparse.ArgumentParser(
             description="Copy and sort the files from source folder to destination folder",
             epilog="Good bye!")
-        parser.add_argument("-s", "--source", type=str, required=True, help="Source folder")
+        parser.add_argument("-s", "--source", type=str, default=None, help="Source folder")
         parser.add_argument("-o", "--output", type=str, default="output", help="output folder (default \"output\")")
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=DEFAULT_WORKERS,
+            help=f"Number of concurrent copy workers (default {DEFAULT_WORKERS})",
+        )
+        parser.add_argument(
+            "--max-inflight-bytes",
+            type=parse_size,
+            default=None,
+            help="Maximum total size of the files being copied at the same time, e.g. 512M (default unlimited)",
+        )
+        parser.add_argument(
+            "--walkers",
+            type=int,
+            default=DEFAULT_WALKERS,
+            help=f"Number of source folders scanned concurrently (default {DEFAULT_WALKERS})",
+        )
+        parser.add_argument(
+            "--copy-mode",
+            type=str,
+            choices=COPY_MODES,
+            default="auto",
+            help="File copy method, \"auto\" tries reflink, copy_file_range, sendfile and buffered copy in order "
+                 "(default \"auto\")",
+        )
+        parser.add_argument(
+            "--link-mode",
+            type=str,
+            choices=LINK_MODES,
+            default="copy",
+            help="Materialize the sorted tree with copies or with hard links, symbolic links or reflinks "
+                 "to the source files, or move the source files (default \"copy\")",
+        )
+        parser.add_argument(
+            "-m",
+            "--move",
+            action="store_true",
+            help="Move the files instead of copying them (same as --link-mode move): renamed on the same "
+                 "filesystem, copied, verified and removed across filesystems",
+        )
+        parser.add_argument(
+            "-p",
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of worker processes, the files are sharded between them by name (default 1)",
+        )
+        parser.add_argument(
+            "-i",
+            "--incremental",
+            action="store_true",
+            help="Copy only the new and changed files, resuming the interrupted runs "
+                 f"(the copies are tracked in {MANIFEST_NAME} in the output folder)",
+        )
+        parser.add_argument(
+            "--dedupe",
+            action="store_true",
+            help="Copy every distinct file content once, skipping the duplicates",
+        )
+        parser.add_argument(
+            "--dedupe-link",
+            action="store_true",
+            help="Copy every distinct file content once, hard linking the duplicates to the copy",
+        )
+        parser.add_argument(
+            "--small-file-size",
+            type=parse_size,
+            default=DEFAULT_SMALL_FILE_SIZE,
+            help="Files up to this size are copied in batches, 0 disables the batching (default 64K)",
+        )
+        parser.add_argument(
+            "--large-file-size",
+            type=parse_size,
+            default=DEFAULT_LARGE_FILE_SIZE,
+            help="Files from this size are copied by chunks in parallel, 0 disables the chunking (default 256M)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=parse_size,
+            default=DEFAULT_CHUNK_SIZE,
+            help="Size of a chunk of a large file (default 64M)",
+        )
+        parser.add_argument(
+            "--routes",
+            type=str,
+            default=None,
+            help="JSON file of the routing rules: extension sets, globs and regular expressions mapped to "
+                 "destination folder templates with {ext}, {name}, {stem}, {year}, {month}, {day} and {size_class} "
+                 "(default a folder per extension)",
+        )
+        parser.add_argument(
+            "--include",
+            type=str,
+            action="append",
+            default=None,
+            help="Copy only the files matching the glob pattern (repeatable); the pattern matches the file name, "
+                 "or the path relative to the source folder if it contains \"/\"",
+        )
+        parser.add_argument(
+            "--exclude",
+            type=str,
+            action="append",
+            default=None,
+            help="Skip the files and the folders matching the glob pattern (repeatable), e.g. .git or node_modules; "
+                 "the excluded folders are not scanned at all",
+        )
+        parser.add_argument(
+            "--max-depth",
+            type=int,
+            default=None,
+            help="Maximum depth of the scanned subfolders, 0 scans the source folder only (default unlimited)",
+        )
+        parser.add_argument(
+            "--min-size",
+            type=parse_size,
+            default=None,
+            help="Skip the files smaller than this size, e.g. 1K",
+        )
+        parser.add_argument(
+            "--max-size",
+            type=parse_size,
+            default=None,
+            help="Skip the files larger than this size, e.g. 1G",
+        )
+        parser.add_argument(
+            "--newer-than",
+            type=parse_time,
+            default=None,
+            help="Skip the files modified before this time: an ISO date (and time), e.g. 2024-01-31, "
+                 "or an age, e.g. 7d (s, m, h, d, w)",
+        )
+        parser.add_argument(
+            "--follow-symlinks",
+            action="store_true",
+            help="Follow the symbolic links to files and folders, every folder is scanned once so the link loops "
+                 "are cut (by default the links are skipped)",
+        )
+        parser.add_argument(
+            "--hardlinks",
+            action="store_true",
+            help="Copy every source file with several hard links once, hard linking its other links to the copy",
+        )
+        parser.add_argument(
+            "--io-backend",
+            type=str,
+            choices=list(IO_BACKENDS),
+            default="default",
+            help="Executor of the file operations: the default executor of the event loop or "
+                 "a dedicated thread pool (default \"default\")",
+        )
+        parser.add_argument(
+            "--io-threads",
+            type=int,
+            default=None,
+            help=f"Number of the threads of the \"threads\" I/O backend (default {DEFAULT_IO_THREADS})",
+        )
+        parser.add_argument(
+            "-n",
+            "--dry-run",
+            action="store_true",
+            help="Do not copy anything, only write the copy plan (JSON lines) and log its totals per folder",
+        )
+        parser.add_argument(
+            "--plan-output",
+            type=str,
+            default=None,
+            help="File of the copy plan of the dry run (default standard output)",
+        )
+        parser.add_argument(
+            "--plan",
+            type=str,
+            default=None,
+            help="Execute the copy plan written by the dry run instead of walking the source folder",
+        )
+        parser.add_argument(
+            "--plan-shard",
+            type=parse_shard,
+            default=(0, 1),
+            help="Execute only a part of the copy plan, e.g. 2/4 - the second of four parts (default 1/1)",
+        )
+        parser.add_argument(
+            "--progress",
+            type=float,
+            default=DEFAULT_PROGRESS_INTERVAL,
+            help="Interval of the progress reports in seconds, 0 disables them "
+                 f"(default {DEFAULT_PROGRESS_INTERVAL:g})",
+        )
+        parser.add_argument(
+            "--stats-json",
+            type=str,
+            default=None,
+            help="Write the counters and the time spent per phase (walk, naming, mkdir, copy) to a JSON file",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=None,
+            help="Expose the counters and the copy latency histogram on http://HOST:PORT/metrics "
+                 "in the Prometheus text format (default disabled)",
+        )
+        parser.add_argument(
+            "--metrics-host",
+            type=str,
+            default=DEFAULT_METRICS_HOST,
+            help=f"Listening address of the metrics endpoint (default {DEFAULT_METRICS_HOST})",
+        )
+        parser.add_argument(
+            "--log-level",
+            type=str.upper,
+            choices=LOG_LEVELS,
+            default="INFO",
+            help="Logging level, DEBUG logs every copied file and scanned folder (default INFO)",
+        )
+        parser.add_argument(
+            "-q",
+            "--quiet",
+            action="store_true",
+            help="Log only the warnings and errors (same as --log-level WARNING)",
+        )
+        parser.add_argument(
+            "--queue-size",
+            type=int,
+            default=DEFAULT_QUEUE_SIZE,
+            help=f"Maximum number of discovered files waiting for copying (default {DEFAULT_QUEUE_SIZE})",
+        )
 
         args = parser.parse_args()
+        logging.getLogger().setLevel(logging.WARNING if args.quiet else args.log_level)
+        if args.source is None and args.plan is None:
+            parser.error("the following arguments are required: -s/--source (or --plan)")
+        if args.move:
+            if args.link_mode not in ("copy", "move"):
+                parser.error(f"argument -m/--move: not allowed with --link-mode {args.link_mode}")
+            args.link_mode = "move"
 
         start_time: float = time.perf_counter()
-        asyncio.run(folder_copy(args.source, args.output))
+        asyncio.run(
+            folder_copy(
+                args.source,
+                args.output,
+                workers=args.workers,
+                queue_size=args.queue_size,
+                max_inflight_bytes=args.max_inflight_bytes,
+                walkers=args.walkers,
+                copy_mode=args.copy_mode,
+                link_mode=args.link_mode,
+                processes=args.processes,
+                incremental=args.incremental,
+                dedupe=args.dedupe,
+                dedupe_link=args.dedupe_link,
+                small_file_size=args.small_file_size,
+                large_file_size=args.large_file_size,
+                chunk_size=args.chunk_size,
+                routes=args.routes,
+                include=args.include,
+                exclude=args.exclude,
+                max_depth=args.max_depth,
+                min_size=args.min_size,
+                max_size=args.max_size,
+                newer_than=args.newer_than,
+                follow_symlinks=args.follow_symlinks,
+                hardlinks=args.hardlinks,
+                io_backend_name=args.io_backend,
+                io_threads=args.io_threads,
+                dry_run=args.dry_run,
+                plan_output=args.plan_output,
+                plan=args.plan,
+                plan_shard=args.plan_shard,
+                progress_interval=args.progress,
+                stats_output=args.stats_json,
+                metrics_host=args.metrics_host,
+                metrics_port=args.metrics_port,
+            )
+        )
         logging.info(f"File copying completed (execution time: {(time.perf_counter() - start_time):.06f} seconds)")
     except Exception as e:
         logging.error(e)
+    finally:
+        listener.stop()
 
     exit(0)
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for Task 1: synthetic source trees and the timings of the walk, naming and copy phases
+"""
+
+import asyncio
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from aiopath import AsyncPath
+from collections import defaultdict
+from typing import Callable, Optional, Union
+
+from .task_01 import (
+    DEFAULT_WALKERS, DEFAULT_WORKERS, KeyedLock, NameRegistry, SourceFile, file_path_build, folder_copy,
+    iter_folder, setup_logging,
+)
+
+# Preferred root of the synthetic trees: tmpfs, so the disk speed does not blur the timings
+TMPFS_ROOT: str = "/dev/shm"
+
+# Numbers of the unique file names of the lock table benchmark (multiplied by the scale)
+LOCK_NAMES: tuple[int, ...] = (10000, 100000, 300000)
+
+# Number of the concurrent name claims of the lock table benchmark, as with the default copy workers
+LOCK_CONCURRENCY: int = 64
+
+# Extensions of the generated files
+EXTENSIONS: tuple[str, ...] = ("txt", "jpg", "png", "pdf", "docx", "mp3", "csv", "json", "py", "")
+
+
+def write_file(path: str, size: int) -> None:
+    """
+    Write a file of the given size.
+
+    :param path: File path
+    :param size: File size, bytes
+    """
+    with open(path, "wb") as file:
+        file.write(os.urandom(min(size, 1024 ** 2)) * (size // 1024 ** 2) + os.urandom(size % 1024 ** 2))
+
+
+def file_name(index: int, extension: str) -> str:
+    """
+    :param index: File index
+    :param extension: File extension (empty - no extension)
+    :return: File name
+    """
+    return f"file_{index}.{extension}" if extension else f"file_{index}"
+
+
+def make_deep(root: str, scale: float) -> None:
+    """
+    A single chain of nested folders with a few files on every level.
+    """
+    folder: str = root
+    for level in range(max(int(200 * scale), 1)):
+        folder = os.path.join(folder, f"level_{level}")
+        os.mkdir(folder)
+        for index in range(5):
+            write_file(os.path.join(folder, file_name(level * 5 + index, EXTENSIONS[index])), 1024)
+
+
+def make_wide(root: str, scale: float) -> None:
+    """
+    Many sibling folders with a few files each.
+    """
+    for folder_index in range(max(int(2000 * scale), 1)):
+        folder: str = os.path.join(root, f"folder_{folder_index}")
+        os.mkdir(folder)
+        for index in range(5):
+            write_file(os.path.join(folder, file_name(folder_index * 5 + index, EXTENSIONS[index])), 1024)
+
+
+def make_tiny(root: str, scale: float) -> None:
+    """
+    Many tiny files (up to 512 bytes).
+    """
+    generator: random.Random = random.Random(0)
+    for index in range(max(int(20000 * scale), 1)):
+        folder: str = os.path.join(root, f"folder_{index % 20}")
+        os.makedirs(folder, exist_ok=True)
+        extension: str = EXTENSIONS[index % len(EXTENSIONS)]
+        write_file(os.path.join(folder, file_name(index, extension)), generator.randint(1, 512))
+
+
+def make_huge(root: str, scale: float) -> None:
+    """
+    A few huge files.
+    """
+    for index in range(4):
+        write_file(os.path.join(root, file_name(index, "bin")), max(int(256 * 1024 ** 2 * scale), 1))
+
+
+def make_collisions(root: str, scale: float) -> None:
+    """
+    The same file names in many folders, so most of the destination names get a copy index.
+    """
+    for folder_index in range(max(int(50 * scale), 1)):
+        folder: str = os.path.join(root, f"folder_{folder_index}")
+        os.mkdir(folder)
+        for index in range(200):
+            write_file(os.path.join(folder, file_name(index, EXTENSIONS[index % len(EXTENSIONS)])), 128)
+
+
+def make_extensions(root: str, scale: float) -> None:
+    """
+    Many distinct extensions, so many destination folders are created.
+    """
+    for index in range(max(int(10000 * scale), 1)):
+        folder: str = os.path.join(root, f"folder_{index % 10}")
+        os.makedirs(folder, exist_ok=True)
+        write_file(os.path.join(folder, file_name(index, f"ext{index % 500}")), 128)
+
+
+# Synthetic source trees: name -> generator(root, scale)
+SCENARIOS: dict[str, Callable[[str, float], None]] = {
+    "deep": make_deep,
+    "wide": make_wide,
+    "tiny": make_tiny,
+    "huge": make_huge,
+    "collisions": make_collisions,
+    "extensions": make_extensions,
+}
+
+
+async def time_walk(source: AsyncPath, walkers: int) -> tuple[float, list[SourceFile]]:
+    """
+    Time the walk of the source folder alone.
+
+    :param source: Source folder
+    :param walkers: Number of source folders scanned concurrently
+    :return: Duration, seconds, and the found files
+    """
+    start: float = time.perf_counter()
+    files: list[SourceFile] = [file async for file in iter_folder(source, walkers=walkers)]
+    return time.perf_counter() - start, files
+
+
+async def time_naming(files: list[SourceFile], dest: AsyncPath) -> float:
+    """
+    Time the building of the destination names alone (nothing is created on disk).
+
+    :param files: Source files
+    :param dest: Destination folder (not existing)
+    :return: Duration, seconds
+    """
+    registry: NameRegistry = NameRegistry()
+    start: float = time.perf_counter()
+    for file in files:
+        await file_path_build(file.path, dest, registry)
+    return time.perf_counter() - start
+
+
+async def run_scenario(source: str, work: str, walkers: int, workers: int, processes: int) -> dict:
+    """
+    Run the phases of the benchmark once on a generated source tree.
+
+    :param source: Source folder
+    :param work: Folder for the destination and the counters of the run
+    :param walkers: Number of source folders scanned concurrently
+    :param workers: Number of concurrent copy workers
+    :param processes: Number of worker processes
+    :return: Timings and counters of the run
+    """
+    dest: str = os.path.join(work, "dest")
+    stats_output: str = os.path.join(work, "stats.json")
+
+    walk_seconds, files = await time_walk(AsyncPath(source), walkers)
+    naming_seconds: float = await time_naming(files, AsyncPath(dest))
+
+    start: float = time.perf_counter()
+    await folder_copy(
+        source, dest, workers=workers, walkers=walkers, processes=processes, progress_interval=0,
+        stats_output=stats_output,
+    )
+    copy_seconds: float = time.perf_counter() - start
+    with open(stats_output, encoding="utf-8") as stats_file:
+        stats: dict = json.load(stats_file)
+    shutil.rmtree(dest)
+
+    return {
+        "files": len(files),
+        "bytes": sum(file.size for file in files),
+        "walk_seconds": walk_seconds,
+        "naming_seconds": naming_seconds,
+        "copy_seconds": copy_seconds,
+        "files_copied": stats["files_copied"],
+        "files_failed": stats["files_failed"],
+        "phase_seconds": stats["phase_seconds"],
+    }
+
+
+def benchmark(
+        scenarios: list[str],
+        root: Optional[str] = None,
+        scale: float = 1.0,
+        repeat: int = 3,
+        walkers: int = DEFAULT_WALKERS,
+        workers: int = DEFAULT_WORKERS,
+        processes: int = 1,
+) -> dict[str, dict]:
+    """
+    Generate the synthetic source trees and time the walk, naming and copy phases on them.
+
+    The walk and the naming are timed alone (wall time), the copy is the whole folder_copy run;
+    its cumulative per-phase timings are reported as well. The median of the repeated runs is kept.
+
+    :param scenarios: Names of the scenarios, keys of SCENARIOS
+    :param root: Folder for the generated trees (None - tmpfs if available, otherwise the temporary folder)
+    :param scale: Multiplier of the number (or the size, for "huge") of the generated files
+    :param repeat: Number of runs per scenario
+    :param walkers: Number of source folders scanned concurrently
+    :param workers: Number of concurrent copy workers
+    :param processes: Number of worker processes
+    :return: Results per scenario
+    """
+    if root is None:
+        root = TMPFS_ROOT if os.path.isdir(TMPFS_ROOT) else tempfile.gettempdir()
+
+    results: dict[str, dict] = {}
+    for name in scenarios:
+        work: str = tempfile.mkdtemp(prefix=f"folder_copy_bench_{name}_", dir=root)
+        try:
+            source: str = os.path.join(work, "source")
+            os.mkdir(source)
+            start: float = time.perf_counter()
+            SCENARIOS[name](source, scale)
+            print(f"Scenario {name}: generated in {time.perf_counter() - start:.3f}s", flush=True)
+
+            runs: list[dict] = [
+                asyncio.run(run_scenario(source, work, walkers, workers, processes)) for _ in range(repeat)
+            ]
+            result: dict = dict(runs[0])
+            for key in ("walk_seconds", "naming_seconds", "copy_seconds"):
+                result[key] = statistics.median(run[key] for run in runs)
+            result["phase_seconds"] = {
+                phase: statistics.median(run["phase_seconds"][phase] for run in runs)
+                for phase in runs[0]["phase_seconds"]
+            }
+            results[name] = result
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+    return results
+
+
+async def measure_lock_memory(names: int, keyed: bool, concurrency: int = LOCK_CONCURRENCY) -> dict:
+    """
+    Measure the memory of the per-name lock table after claiming many unique names,
+    as the copy workers do with the destination file names.
+
+    :param names: Number of the unique names
+    :param keyed: Use the refcounted KeyedLock, otherwise a never shrinking defaultdict of locks
+    :param concurrency: Number of the concurrent claims
+    :return: Memory retained after the claims and its peak, MB, and the lock entries left
+    """
+    locks: Union[KeyedLock, defaultdict] = KeyedLock() if keyed else defaultdict(asyncio.Lock)
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+
+    async def claim(index: int) -> None:
+        async with semaphore:
+            name: str = f"file_{index}.txt"
+            async with (locks.hold(name) if keyed else locks[name]):
+                await asyncio.sleep(0)
+
+    tracemalloc.start()
+    try:
+        # The claims are started in chunks, so the pending coroutines do not dominate the measurement
+        for start in range(0, names, 10000):
+            await asyncio.gather(*[claim(index) for index in range(start, min(names, start + 10000))])
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"names": names, "current_mb": current / 1024 ** 2, "peak_mb": peak / 1024 ** 2, "entries": len(locks)}
+
+
+def benchmark_locks(scale: float = 1.0) -> dict[str, dict]:
+    """
+    Compare the memory of the KeyedLock table with a defaultdict of locks over growing numbers of unique names:
+    the KeyedLock memory must stay flat.
+
+    :param scale: Multiplier of the numbers of the names
+    :return: Results per lock table and number of names
+    """
+    results: dict[str, dict] = {}
+    for names in LOCK_NAMES:
+        names = max(int(names * scale), 1)
+        for keyed in (False, True):
+            table: str = "KeyedLock" if keyed else "defaultdict"
+            results[f"{table}/{names}"] = asyncio.run(measure_lock_memory(names, keyed))
+    return results
+
+
+def print_lock_results(results: dict[str, dict]) -> None:
+    """
+    Print the results of the lock table benchmark as a table.
+
+    :param results: Results per lock table and number of names
+    """
+    print(f"{'lock table':<20}{'names':>9}{'retained, MB':>14}{'peak, MB':>10}{'entries':>9}")
+    for name, result in results.items():
+        print(
+            f"{name.split('/')[0]:<20}{result['names']:>9}{result['current_mb']:>14.1f}"
+            f"{result['peak_mb']:>10.1f}{result['entries']:>9}"
+        )
+
+
+def print_results(results: dict[str, dict]) -> None:
+    """
+    Print the results of the benchmark as a table.
+
+    :param results: Results per scenario
+    """
+    print(f"{'scenario':<12}{'files':>9}{'MB':>9}{'walk, s':>10}{'naming, s':>11}{'copy, s':>10}"
+          f"{'files/s':>10}{'MB/s':>9}  cumulative phases")
+    for name, result in results.items():
+        megabytes: float = result["bytes"] / 1024 ** 2
+        phases: str = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in result["phase_seconds"].items())
+        print(
+            f"{name:<12}{result['files']:>9}{megabytes:>9.1f}{result['walk_seconds']:>10.3f}"
+            f"{result['naming_seconds']:>11.3f}{result['copy_seconds']:>10.3f}"
+            f"{result['files'] / result['copy_seconds']:>10.0f}{megabytes / result['copy_seconds']:>9.1f}  {phases}"
+        )
+
+
+def cli() -> None:
+    """
+    CLI for benchmarking the folder copying on synthetic source trees.
+    """
+    listener = setup_logging(logging.WARNING)
+    try:
+        parser = argparse.ArgumentParser(
+            description="Benchmark the sorting copy of a folder on synthetic source trees",
+            epilog="Good bye!")
+        parser.add_argument(
+            "scenarios",
+            nargs="*",
+            help=f"Scenarios to run: {', '.join(SCENARIOS)} (default all)",
+        )
+        parser.add_argument(
+            "--root",
+            type=str,
+            default=None,
+            help=f"Folder for the generated trees (default {TMPFS_ROOT} if available, otherwise the temporary folder)",
+        )
+        parser.add_argument(
+            "--scale",
+            type=float,
+            default=1.0,
+            help="Multiplier of the number of the generated files, or of their size for \"huge\" (default 1)",
+        )
+        parser.add_argument("--repeat", type=int, default=3, help="Number of runs per scenario (default 3)")
+        parser.add_argument(
+            "--walkers",
+            type=int,
+            default=DEFAULT_WALKERS,
+            help=f"Number of source folders scanned concurrently (default {DEFAULT_WALKERS})",
+        )
+        parser.add_argument(
+            "-w",
+            "--workers",
+            type=int,
+            default=DEFAULT_WORKERS,
+            help=f"Number of concurrent copy workers (default {DEFAULT_WORKERS})",
+        )
+        parser.add_argument("-p", "--processes", type=int, default=1, help="Number of worker processes (default 1)")
+        parser.add_argument(
+            "--locks",
+            action="store_true",
+            help="Also measure the memory of the per-name lock table over many unique names "
+                 "(only this benchmark if no scenario is given)",
+        )
+        parser.add_argument(
+            "--json",
+            type=str,
+            default=None,
+            help="Write the results to a JSON file, to compare them run to run",
+        )
+
+        args = parser.parse_args()
+        if unknown := [name for name in args.scenarios if name not in SCENARIOS]:
+            parser.error(f"unknown scenarios: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+        results: dict[str, dict] = {}
+        if args.scenarios or not args.locks:
+            results = benchmark(
+                args.scenarios or list(SCENARIOS),
+                root=args.root,
+                scale=args.scale,
+                repeat=args.repeat,
+                walkers=args.walkers,
+                workers=args.workers,
+                processes=args.processes,
+            )
+            print_results(results)
+        if args.locks:
+            results["locks"] = benchmark_locks(args.scale)
+            print_lock_results(results["locks"])
+        if args.json is not None:
+            with open(args.json, "w", encoding="utf-8") as output:
+                json.dump(results, output, indent=2)
+    except Exception as e:
+        logging.error(e)
+    finally:
+        listener.stop()
+
+    exit(0)
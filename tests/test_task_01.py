@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+Regression tests for Task 1
+"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from tasks.task_01 import folder_copy
+
+
+class IncrementalLinksTest(unittest.TestCase):
+    """
+    The incremental mode combined with the deduplication or the hard links mode
+    must never lose the content of a copied file.
+    """
+
+    def setUp(self) -> None:
+        self.temporary = tempfile.TemporaryDirectory()
+        self.source: str = os.path.join(self.temporary.name, "source")
+        self.dest: str = os.path.join(self.temporary.name, "dest")
+        os.makedirs(self.source)
+
+    def tearDown(self) -> None:
+        self.temporary.cleanup()
+
+    def write(self, name: str, content: str, mtime: int) -> None:
+        path: str = os.path.join(self.source, name)
+        with open(path, "w") as stream:
+            stream.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def copy(self, **kwargs) -> dict[str, str]:
+        asyncio.run(folder_copy(self.source, self.dest, incremental=True, **kwargs))
+        folder: str = os.path.join(self.dest, "txt")
+        contents: dict[str, str] = {}
+        for name in os.listdir(folder):
+            with open(os.path.join(folder, name)) as stream:
+                contents[name] = stream.read()
+        return contents
+
+    def check_changed_duplicate(self, **kwargs) -> None:
+        self.write("a.txt", "AAAA", 1000)
+        self.write("b.txt", "AAAA", 1000)
+        self.copy(**kwargs)
+        self.write("b.txt", "BBBBBBBB", 2000)
+        self.assertEqual(sorted(self.copy(**kwargs).values()), ["AAAA", "BBBBBBBB"])
+
+    def check_changed_original(self, **kwargs) -> None:
+        self.write("a.txt", "AAAA", 1000)
+        self.write("b.txt", "AAAA", 1000)
+        self.copy(**kwargs)
+        self.write("a.txt", "CCCCCCCC", 2000)
+        self.copy(**kwargs)
+        self.assertEqual(sorted(self.copy(**kwargs).values()), ["AAAA", "CCCCCCCC"])
+
+    def test_changed_duplicate_skipped(self) -> None:
+        self.check_changed_duplicate(dedupe=True)
+
+    def test_changed_duplicate_linked(self) -> None:
+        self.check_changed_duplicate(dedupe_link=True)
+
+    def test_changed_original_skipped(self) -> None:
+        self.check_changed_original(dedupe=True)
+
+    def test_changed_original_linked(self) -> None:
+        self.check_changed_original(dedupe_link=True)
+
+    def test_changed_hard_link(self) -> None:
+        self.write("a.txt", "AAAA", 1000)
+        os.link(os.path.join(self.source, "a.txt"), os.path.join(self.source, "b.txt"))
+        self.copy(hardlinks=True)
+        os.unlink(os.path.join(self.source, "b.txt"))
+        self.write("b.txt", "BBBBBBBB", 2000)
+        self.assertEqual(self.copy(hardlinks=True), {"a.txt": "AAAA", "b.txt": "BBBBBBBB"})
+
+
+
+class InPlaceTest(unittest.TestCase):
+    """
+    Sorting into the source folder itself must process every source file once.
+    """
+
+    def setUp(self) -> None:
+        self.temporary = tempfile.TemporaryDirectory()
+        self.source: str = self.temporary.name
+        for index in range(300):
+            with open(os.path.join(self.source, f"f{index}.{('txt', 'jpg', 'pdf')[index % 3]}"), "w") as stream:
+                stream.write(str(index))
+
+    def tearDown(self) -> None:
+        self.temporary.cleanup()
+
+    def files(self) -> list[str]:
+        return sorted(
+            os.path.relpath(os.path.join(folder, name), self.source)
+            for folder, _, names in os.walk(self.source) for name in names
+        )
+
+    def test_copy(self) -> None:
+        asyncio.run(folder_copy(self.source, self.source))
+        files: list[str] = self.files()
+        self.assertEqual(len(files), 600)
+        self.assertFalse([name for name in files if " (" in name])
+
+    def test_move(self) -> None:
+        asyncio.run(folder_copy(self.source, self.source, link_mode="move"))
+        with open(os.path.join(self.source, "new.jpg"), "w") as stream:
+            stream.write("new")
+        # The sorted folders are walked again by the second run
+        asyncio.run(folder_copy(self.source, self.source, link_mode="move"))
+        files: list[str] = self.files()
+        self.assertEqual(len(files), 301)
+        self.assertFalse([name for name in files if " (" in name or os.sep not in name])
+
+
+
+class PlanTest(unittest.TestCase):
+    """
+    The replay of a copy plan must not overwrite the files found at the planned destinations.
+    """
+
+    def setUp(self) -> None:
+        self.temporary = tempfile.TemporaryDirectory()
+        self.source: str = os.path.join(self.temporary.name, "source")
+        self.dest: str = os.path.join(self.temporary.name, "dest")
+        self.plan: str = os.path.join(self.temporary.name, "plan.jsonl")
+        os.makedirs(self.source)
+        with open(os.path.join(self.source, "a.txt"), "w") as stream:
+            stream.write("ours")
+
+    def tearDown(self) -> None:
+        self.temporary.cleanup()
+
+    def test_taken_destination(self) -> None:
+        asyncio.run(folder_copy(self.source, self.dest, dry_run=True, plan_output=self.plan))
+        os.makedirs(os.path.join(self.dest, "txt"))
+        with open(os.path.join(self.dest, "txt", "a.txt"), "w") as stream:
+            stream.write("theirs")
+        asyncio.run(folder_copy("", self.dest, plan=self.plan))
+        contents: dict[str, str] = {}
+        for name in os.listdir(os.path.join(self.dest, "txt")):
+            with open(os.path.join(self.dest, "txt", name)) as stream:
+                contents[name] = stream.read()
+        self.assertEqual(contents, {"a.txt": "theirs", "a (1).txt": "ours"})
+
+
+if __name__ == "__main__":
+    unittest.main()